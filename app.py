@@ -1,21 +1,103 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, jsonify, Response, g, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func, select, tuple_, union
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
+import functools
+import io
 import os
+import click
 from werkzeug.utils import secure_filename
+import json
+import re
+from database import database_url, engine_options
+import migrations
+from cache import TTLCache
+from passwords import PasswordPolicy, PasswordHashingBusy
+import stats as doctor_stats
+import scheduling
+import instrumentation
+from pubsub import create_broker
+from storage import create_attachment_store
+from images import ImagePipeline, make_avatar_variants
+import bulk
+import archive
+import search
+import badges
+from scheduler import Scheduler
+import httpcache
+from httpcache import conditional
+import uuid
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///doctor_referral.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# 'local' only reaches clients in the same process; use 'database' when running several workers
+app.config['PUBSUB_BACKEND'] = os.environ.get('PUBSUB_BACKEND', 'local')
+app.config['PUBSUB_DATABASE_URL'] = os.environ.get('PUBSUB_DATABASE_URL', 'sqlite:///pubsub.db')
+app.config['STREAM_KEEPALIVE_SECONDS'] = 15
+# Message attachments: 'local' keeps them under ATTACHMENT_FOLDER, 's3' needs boto3 and ATTACHMENT_BUCKET
+app.config['ATTACHMENT_BACKEND'] = os.environ.get('ATTACHMENT_BACKEND', 'local')
+app.config['ATTACHMENT_FOLDER'] = os.environ.get('ATTACHMENT_FOLDER', 'attachments')
+app.config['ATTACHMENT_BUCKET'] = os.environ.get('ATTACHMENT_BUCKET')
+app.config['ATTACHMENT_ENDPOINT_URL'] = os.environ.get('ATTACHMENT_ENDPOINT_URL')
+app.config['ATTACHMENT_MAX_AGE'] = 365 * 24 * 60 * 60
+# e.g. 'pbkdf2:sha256:600000', 'scrypt:32768:8:1' or 'argon2' (needs argon2-cffi).
+# Existing hashes are upgraded on the next successful login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+# Set to dump cProfile stats for requests slower than this many milliseconds
+app.config['PROFILE_SLOW_REQUESTS_MS'] = int(os.environ.get('PROFILE_SLOW_REQUESTS_MS', 0))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+# If set, /metrics requires "Authorization: Bearer <token>"; otherwise it only
+# answers requests from localhost
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Bulk import/export API (/api/admin/...) is disabled unless this is set;
+# callers send "Authorization: Bearer <token>"
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+# Processes used to hash passwords during bulk imports (default: one per core)
+app.config['IMPORT_HASH_WORKERS'] = int(os.environ.get('IMPORT_HASH_WORKERS', 0)) or None
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+# `flask archive-messages` moves messages older than this into compressed
+# per-conversation segments, loaded only when a chat is scrolled back
+app.config['MESSAGE_ARCHIVE_AFTER_DAYS'] = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', 90))
+app.config['MESSAGE_ARCHIVE_SEGMENT_SIZE'] = int(os.environ.get('MESSAGE_ARCHIVE_SEGMENT_SIZE', 500))
+# Background jobs (navbar badge counts) run on a thread in each web process.
+# Set SCHEDULER=off on the web processes when running `flask run-worker` instead.
+app.config['SCHEDULER_ENABLED'] = os.environ.get('SCHEDULER', 'on') != 'off'
+app.config['BADGE_REFRESH_SECONDS'] = int(os.environ.get('BADGE_REFRESH_SECONDS', 30))
+# The app refuses to start on an out-of-date schema; SCHEMA_CHECK=off skips that (tests, benchmarks)
+app.config['SCHEMA_CHECK'] = os.environ.get('SCHEMA_CHECK', 'on') != 'off'
 
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+instrumentation.init_app(app)
+httpcache.init_app(app)
+password_policy = PasswordPolicy(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'])
+image_pipeline = ImagePipeline(max_workers=int(os.environ.get('IMAGE_WORKERS', 2)))
+broker = create_broker(app.config['PUBSUB_BACKEND'], app.config['PUBSUB_DATABASE_URL'])
+attachments = create_attachment_store(
+    app.config['ATTACHMENT_BACKEND'],
+    app.config['ATTACHMENT_FOLDER'],
+    app.config['ATTACHMENT_BUCKET'],
+    app.config['ATTACHMENT_ENDPOINT_URL']
+)
+
+class UploadRequest(Request):
+    # Multipart file parts are written straight to a hashing temp file in
+    # chunks as they are parsed, instead of being buffered first
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return attachments.spool_file()
+
+app.request_class = UploadRequest
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -28,11 +110,56 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 # Create uploads directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Raw avatar uploads waiting for the image pipeline (kept out of static/)
+AVATAR_INBOX = os.path.join(app.instance_path, 'avatar_inbox')
+os.makedirs(AVATAR_INBOX, exist_ok=True)
+
+# Doctors per page in the directory (/requests, /book_appointment, /api/doctors)
+DIRECTORY_PAGE_SIZE = 20
+MAX_DIRECTORY_PAGE_SIZE = 100
+
+# Consultation queue: emergencies first, then urgent, then normal
+PRIORITY_ORDER = ('emergency', 'urgent', 'normal')
+QUEUE_PAGE_SIZE = 20
+MAX_QUEUE_PAGE_SIZE = 100
+QUEUE_DEFAULT_STATUSES = ('pending', 'accepted')
+
+# Scheduling: each appointment blocks a fixed slot on the receiver's calendar
+APPOINTMENT_DURATION = timedelta(minutes=int(os.environ.get('APPOINTMENT_MINUTES', 30)))
+ACTIVE_APPOINTMENT_STATUSES = ('pending', 'accepted')
+MAX_SLOT_RANGE = timedelta(days=31)
+
+# Seconds a client is told to wait when the password hashing pool is full
+PASSWORD_BUSY_RETRY_AFTER = 5
+
+# Tables available to the audit export
+EXPORT_KINDS = ('appointments', 'messages')
+
+# Clients allowed to read /metrics when no METRICS_TOKEN is set
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Messages returned per /get_messages call
+MESSAGE_PAGE_SIZE = 100
+MAX_MESSAGE_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # Models
-class Doctor(UserMixin, db.Model):
+class ConnectionsMixin:
+    def is_connected_to(self, other_id):
+        # Point lookup on the canonical pair, memoized for the rest of the request
+        cache = g.setdefault('connected_pairs', {})
+        pair = Connection.pair(self.id, other_id)
+        if pair not in cache:
+            cache[pair] = db.session.query(Connection.id).filter_by(
+                low_id=pair[0], high_id=pair[1], status='accepted'
+            ).first() is not None
+        return cache[pair]
+
+class Doctor(ConnectionsMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     full_name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -41,8 +168,10 @@ class Doctor(UserMixin, db.Model):
     npi_id = db.Column(db.String(50), unique=True, nullable=False)
     state = db.Column(db.String(50), nullable=False)
     address = db.Column(db.String(200), nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
     avatar_path = db.Column(db.String(200))
+    avatar_variants = db.Column(db.Text)  # JSON: {size: {format: filename}} under UPLOAD_FOLDER
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     connections = db.relationship('Connection', foreign_keys='Connection.doctor1_id', backref='doctor1', lazy=True)
     connections2 = db.relationship('Connection', foreign_keys='Connection.doctor2_id', backref='doctor2', lazy=True)
     sent_appointments = db.relationship('Appointment', foreign_keys='Appointment.sender_id', backref='sender', lazy=True)
@@ -50,22 +179,71 @@ class Doctor(UserMixin, db.Model):
     sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy=True)
     received_messages = db.relationship('Message', foreign_keys='Message.receiver_id', backref='receiver', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_doctor_specialization_state', 'specialization', 'state'),
+        db.Index('ix_doctor_state', 'state'),
+        db.Index('ix_doctor_full_name', 'full_name'),
+        db.Index('ix_doctor_updated_at', 'updated_at'),
+    )
+
     def set_password(self, password):
         if not password:
             raise ValueError("Password cannot be empty")
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
+        self.password_hash = password_policy.hash(password)
 
     def check_password(self, password):
         if not password or not self.password_hash:
             return False
-        return check_password_hash(self.password_hash, password)
+        if not password_policy.verify(self.password_hash, password):
+            return False
+        if password_policy.needs_rehash(self.password_hash):
+            # Hashing policy changed since this hash was made; caller commits.
+            # If the pool is busy the upgrade waits for the next login.
+            try:
+                self.set_password(password)
+            except PasswordHashingBusy:
+                pass
+        return True
+
+# Directory search index (see search.py); created here for create_all() and
+# by migration 11 for databases from before it existed
+for ddl in search.DOCTOR_SQLITE_DDL:
+    event.listen(Doctor.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+event.listen(Doctor.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS doctor_fts').execute_if(dialect='sqlite'))
 
 class Connection(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    doctor1_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
-    doctor2_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    doctor1_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)  # requester
+    doctor2_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)  # recipient
+    # Unordered pair (min, max) of the two doctor ids, so each pair has exactly one row
+    low_id = db.Column(db.Integer, nullable=False)
+    high_id = db.Column(db.Integer, nullable=False)
     status = db.Column(db.String(20), default='pending')  # pending, accepted, rejected
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('low_id', 'high_id', name='uq_connection_pair'),
+        db.Index('ix_connection_doctor1_status', 'doctor1_id', 'status'),
+        db.Index('ix_connection_doctor2_status', 'doctor2_id', 'status'),
+        # Only pending rows, for the badge count refresh
+        db.Index('ix_connection_pending_doctor2', 'doctor2_id',
+                 sqlite_where=db.text("status = 'pending'"), postgresql_where=db.text("status = 'pending'")),
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.low_id, self.high_id = Connection.pair(self.doctor1_id, self.doctor2_id)
+
+    @staticmethod
+    def pair(doctor_a_id, doctor_b_id):
+        a, b = int(doctor_a_id), int(doctor_b_id)
+        return (a, b) if a < b else (b, a)
+
+    @classmethod
+    def between(cls, doctor_a_id, doctor_b_id):
+        low_id, high_id = cls.pair(doctor_a_id, doctor_b_id)
+        return cls.query.filter_by(low_id=low_id, high_id=high_id).first()
 
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -75,6 +253,33 @@ class Appointment(db.Model):
     status = db.Column(db.String(20), default='pending')  # pending, active, cancelled
     priority = db.Column(db.String(20), default='normal')  # emergency, urgent, normal
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_appointment_receiver_date_time', 'receiver_id', 'date_time'),
+        db.Index('ix_appointment_sender_date_time', 'sender_id', 'date_time'),
+        db.Index('ix_appointment_receiver_queue', 'receiver_id', 'status', 'priority', 'date_time'),
+        db.Index('ix_appointment_sender_queue', 'sender_id', 'status', 'priority', 'date_time'),
+        db.Index('ix_appointment_pending_receiver', 'receiver_id',
+                 sqlite_where=db.text("status = 'pending'"), postgresql_where=db.text("status = 'pending'")),
+    )
+
+class DoctorStats(db.Model):
+    # Materialized dashboard counters, maintained by change_appointment_status()
+    # and rebuilt in bulk by `flask rebuild-stats`. pending_incoming feeds the
+    # navbar's appointments badge (see badges.py).
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    total_consultations = db.Column(db.Integer, nullable=False, default=0)
+    total_patients = db.Column(db.Integer, nullable=False, default=0)
+    pending_incoming = db.Column(db.Integer, nullable=False, default=0)
+
+class BadgeCounts(db.Model):
+    # Pending items per doctor for the navbar, refreshed by the scheduler.
+    # Doctors with nothing pending have no row.
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    pending_requests = db.Column(db.Integer, nullable=False, default=0)
+    pending_appointments = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -84,9 +289,330 @@ class Message(db.Model):
     file_path = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_message_sender_receiver_created_at', 'sender_id', 'receiver_id', 'created_at'),
+    )
+
+# Message search index (see search.py); created here for create_all() and by
+# migration 6 for existing databases
+for ddl in search.SQLITE_DDL:
+    event.listen(Message.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+for ddl in search.POSTGRES_DDL:
+    event.listen(Message.__table__, 'after_create', DDL(ddl).execute_if(dialect='postgresql'))
+
+class MessageArchiveSegment(db.Model):
+    # A run of consecutive archived messages of one conversation, as gzipped
+    # JSONL. Written by `flask archive-messages`, read by get_messages()
+    id = db.Column(db.Integer, primary_key=True)
+    low_id = db.Column(db.Integer, nullable=False)
+    high_id = db.Column(db.Integer, nullable=False)
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    first_created_at = db.Column(db.DateTime, nullable=False)
+    last_created_at = db.Column(db.DateTime, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_message_archive_segment_pair', 'low_id', 'high_id', 'last_message_id'),
+    )
+
+def doctor_search_filter(q):
+    terms = re.findall(r'\w+', q)
+    if not terms:
+        return None
+    if db.engine.dialect.name == 'sqlite':
+        # Prefix match on every term, e.g. "sar joh" -> "sar"* "joh"*
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return Doctor.id.in_(db.text('SELECT rowid FROM doctor_fts WHERE doctor_fts MATCH :match')
+                             .bindparams(match=match))
+    return db.and_(*[(Doctor.full_name.ilike(f'%{term}%') | Doctor.specialization.ilike(f'%{term}%'))
+                     for term in terms])
+
+def doctor_directory(viewer_id, q=None, specialization=None, state=None, available_only=False):
+    # Doctors other than the viewer, each paired with the viewer's connection
+    # row (or None), looked up through the unique (low_id, high_id) index
+    pair_match = (
+        ((Connection.low_id == Doctor.id) & (Connection.high_id == viewer_id)) |
+        ((Connection.low_id == viewer_id) & (Connection.high_id == Doctor.id))
+    )
+    query = db.session.query(Doctor, Connection).outerjoin(Connection, pair_match).filter(Doctor.id != viewer_id)
+    if specialization:
+        query = query.filter(Doctor.specialization == specialization)
+    if state:
+        query = query.filter(Doctor.state == state)
+    if q:
+        search = doctor_search_filter(q)
+        if search is not None:
+            query = query.filter(search)
+    if available_only:
+        query = query.filter(Connection.id.is_(None) | (Connection.status == 'rejected'))
+    return query.order_by(Doctor.full_name, Doctor.id)
+
+def connection_status(connection, viewer_id):
+    if connection is None:
+        return 'none'
+    if connection.status == 'pending':
+        return 'request_sent' if connection.doctor1_id == viewer_id else 'request_received'
+    return connection.status
+
+def paginate_directory(query, page, per_page):
+    # Fetch one extra row to know whether there is a next page without a COUNT(*)
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    return rows[:per_page], len(rows) > per_page
+
+def directory_args():
+    return {
+        'q': request.args.get('q', '').strip(),
+        'specialization': request.args.get('specialization', '').strip(),
+        'state': request.args.get('state', '').strip(),
+        'page': max(request.args.get('page', 1, type=int), 1),
+    }
+
+def directory_per_page():
+    return max(1, min(request.args.get('per_page', DIRECTORY_PAGE_SIZE, type=int), MAX_DIRECTORY_PAGE_SIZE))
+
+def change_appointment_status(appointment, new_status):
+    # Compare-and-set on the current status, so two concurrent requests can't
+    # both apply the same transition, then adjust the counters in the same
+    # transaction. Returns False if the appointment was already changed.
+    old_status = appointment.status
+    if old_status == new_status:
+        return False
+    result = db.session.execute(
+        db.update(Appointment)
+        .where((Appointment.id == appointment.id) & (Appointment.status == old_status))
+        .values(status=new_status)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return False
+    set_committed_value(appointment, 'status', new_status)
+    doctor_stats.apply_deltas(db.session.connection(), DoctorStats.__table__, doctor_stats.transition_deltas(
+        appointment.sender_id, appointment.receiver_id, old_status, new_status
+    ))
+    return True
+
+def consultation_queue(direction, doctor_id, statuses, start=None, end=None, cursor=None, limit=QUEUE_PAGE_SIZE):
+    # Keyset-paginated appointments ordered by (priority, date_time, id).
+    # Each priority is read as its own range scan on the
+    # (doctor, status, priority, date_time) index, so no page needs a sort
+    # over the doctor's whole history. Returns (appointments, next_cursor).
+    if direction == 'incoming':
+        doctor_column, other = Appointment.receiver_id, Appointment.sender
+    else:
+        doctor_column, other = Appointment.sender_id, Appointment.receiver
+
+    appointments = []
+    first_rank = cursor[0] if cursor else 0
+    for rank in range(first_rank, len(PRIORITY_ORDER)):
+        query = Appointment.query.options(joinedload(other)).filter(
+            (doctor_column == doctor_id) &
+            Appointment.status.in_(statuses) &
+            (Appointment.priority == PRIORITY_ORDER[rank])
+        )
+        if start is not None:
+            query = query.filter(Appointment.date_time >= start)
+        if end is not None:
+            query = query.filter(Appointment.date_time < end)
+        if cursor and rank == cursor[0]:
+            query = query.filter(tuple_(Appointment.date_time, Appointment.id) > (cursor[1], cursor[2]))
+        # One extra row tells us whether there is another page
+        appointments += query.order_by(Appointment.date_time, Appointment.id).limit(
+            limit + 1 - len(appointments)
+        ).all()
+        if len(appointments) > limit:
+            break
+
+    next_cursor = None
+    if len(appointments) > limit:
+        appointments = appointments[:limit]
+        if appointments:
+            last = appointments[-1]
+            next_cursor = f"{PRIORITY_ORDER.index(last.priority)}|{last.date_time.isoformat()}|{last.id}"
+    return appointments, next_cursor
+
+def parse_queue_cursor(value):
+    try:
+        rank, date_time, appointment_id = value.split('|')
+        cursor = int(rank), datetime.fromisoformat(date_time), int(appointment_id)
+    except (AttributeError, ValueError):
+        return None
+    # A negative rank would index PRIORITY_ORDER from the end and skip priorities
+    if cursor[0] not in range(len(PRIORITY_ORDER)):
+        raise ValueError(f'cursor priority rank must be between 0 and {len(PRIORITY_ORDER) - 1}')
+    return cursor
+
+def queue_args():
+    # Status and date window filters shared by /consultation and /api/consultations
+    statuses = [s for s in request.args.get('status', '').split(',') if s] or list(QUEUE_DEFAULT_STATUSES)
+    start = request.args.get('from', type=lambda v: datetime.strptime(v, '%Y-%m-%d'))
+    end = request.args.get('to', type=lambda v: datetime.strptime(v, '%Y-%m-%d'))
+    if start is None and request.args.get('include_past') != '1':
+        # Past appointments are hidden unless asked for
+        start = datetime.combine(datetime.now().date(), datetime.min.time())
+    return {
+        'statuses': statuses,
+        'start': start,
+        'end': end + timedelta(days=1) if end else None,
+    }
+
+def booked_starts(doctor_id, start, end):
+    # Sorted start times of the doctor's active appointments that can overlap
+    # [start, end); a range scan on the (receiver_id, date_time) index
+    return [date_time for (date_time,) in db.session.query(Appointment.date_time).filter(
+        (Appointment.receiver_id == doctor_id) &
+        Appointment.status.in_(ACTIVE_APPOINTMENT_STATUSES) &
+        (Appointment.date_time > start - APPOINTMENT_DURATION) &
+        (Appointment.date_time < end)
+    ).order_by(Appointment.date_time)]
+
+def lock_schedule(doctor_id):
+    # Serialize bookings for one doctor until the transaction ends: a no-op
+    # write row-locks the doctor on Postgres and takes the write lock on SQLite,
+    # so the conflict check and the insert can't interleave with another booking.
+    # updated_at is set to itself so its onupdate doesn't change the doctor's ETags.
+    db.session.execute(db.update(Doctor).where(Doctor.id == doctor_id).values(updated_at=Doctor.updated_at))
+
+def serialize_message(msg, viewer_id):
+    return {
+        'id': msg.id,
+        'content': msg.content,
+        'file_path': msg.file_path,
+        'created_at': msg.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_sent': msg.sender_id == viewer_id
+    }
+
+def publish_event(recipient_id, event_type, **payload):
+    # Push an event to every open /stream of the given doctor. Callers have
+    # already committed, and clients resync by polling, so a broker failure
+    # is logged rather than failing the request.
+    try:
+        broker.publish(f'doctor:{recipient_id}', dict(payload, type=event_type))
+    except Exception:
+        app.logger.exception('Could not publish %s event to doctor %s', event_type, recipient_id)
+
+class DoctorIdentity(ConnectionsMixin, UserMixin):
+    # Read-only snapshot of a Doctor row (without the password hash) used as
+    # current_user, so authenticated requests don't need to load the ORM object
+    COLUMNS = ('id', 'full_name', 'email', 'specialization', 'phone', 'npi_id',
+               'state', 'address', 'avatar_path', 'avatar_variants')
+
+    def __init__(self, row):
+        for column in self.COLUMNS:
+            setattr(self, column, getattr(row, column))
+
+# Per-process; other workers see changes once their entry expires
+identity_cache = TTLCache(
+    maxsize=int(os.environ.get('IDENTITY_CACHE_SIZE', 4096)),
+    ttl=int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+)
+
+# A changed doctor is evicted once its transaction commits. Evicting at flush
+# time would let a concurrent request re-cache the old row before the commit.
+@event.listens_for(Doctor, 'after_update')
+@event.listens_for(Doctor, 'after_delete')
+def invalidate_identity(mapper, connection, doctor):
+    object_session(doctor).info.setdefault('changed_doctors', set()).add(doctor.id)
+
+@event.listens_for(db.session, 'after_commit')
+def evict_changed_identities(session):
+    for doctor_id in session.info.pop('changed_doctors', ()):
+        identity_cache.pop(doctor_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_identities(session):
+    session.info.pop('changed_doctors', None)
+
+# Per-process; the refresh job clears changed entries in its own process
+badge_cache = TTLCache(maxsize=int(os.environ.get('BADGE_CACHE_SIZE', 4096)), ttl=app.config['BADGE_REFRESH_SECONDS'])
+
+def refresh_badge_counts():
+    with app.app_context():
+        with db.engine.begin() as conn:
+            changed = badges.refresh(conn, Connection.__table__, DoctorStats.__table__, BadgeCounts.__table__,
+                                     datetime.utcnow())
+    for doctor_id, counts in changed.items():
+        badge_cache.pop(doctor_id)
+        publish_event(doctor_id, 'badges', **counts)
+    return len(changed)
+
+scheduler = Scheduler(app.logger)
+scheduler.add('badge_counts', app.config['BADGE_REFRESH_SECONDS'], refresh_badge_counts)
+
+@app.before_request
+def start_scheduler():
+    # Started lazily so CLI commands and forking servers don't inherit a thread
+    if app.config['SCHEDULER_ENABLED']:
+        scheduler.start()
+
 @login_manager.user_loader
 def load_user(user_id):
-    return Doctor.query.get(int(user_id))
+    user_id = int(user_id)
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        row = db.session.query(*[getattr(Doctor, c) for c in DoctorIdentity.COLUMNS]).filter(
+            Doctor.id == user_id
+        ).first()
+        if row is None:
+            return None
+        identity = DoctorIdentity(row)
+        identity_cache.set(user_id, identity)
+    return identity
+
+# Versions for conditional GETs: one aggregate query each, over the rows a
+# view renders. Rows are never deleted, so a count plus the latest
+# updated_at (or id, for immutable messages) changes whenever they do.
+def doctors_version(doctor_ids):
+    # Latest change to the viewer or any doctor in `doctor_ids` (a select of
+    # ids), so edits to doctors a page doesn't show leave its ETag alone
+    return select(func.max(Doctor.updated_at)).where(
+        Doctor.id.in_(doctor_ids) | (Doctor.id == current_user.id)
+    ).scalar_subquery()
+
+def appointments_version(*args, **kwargs):
+    mine = (Appointment.sender_id == current_user.id) | (Appointment.receiver_id == current_user.id)
+    others = union(
+        select(Appointment.sender_id).where(Appointment.receiver_id == current_user.id),
+        select(Appointment.receiver_id).where(Appointment.sender_id == current_user.id),
+    )
+    row = db.session.execute(
+        select(func.count(Appointment.id), func.max(Appointment.updated_at), doctors_version(others)).where(mine)
+    ).one()
+    # Past appointments drop out of the default view at midnight
+    return [current_user.id, datetime.now().date(), *row]
+
+def connections_version(*args, **kwargs):
+    mine = (Connection.doctor1_id == current_user.id) | (Connection.doctor2_id == current_user.id)
+    others = union(
+        select(Connection.doctor1_id).where(Connection.doctor2_id == current_user.id),
+        select(Connection.doctor2_id).where(Connection.doctor1_id == current_user.id),
+    )
+    row = db.session.execute(
+        select(func.count(Connection.id), func.max(Connection.updated_at), doctors_version(others)).where(mine)
+    ).one()
+    return [current_user.id, *row]
+
+def directory_page_version(available_only, per_page):
+    # (id, updated_at) of the doctors on the requested directory page
+    filters = directory_args()
+    return [list(row) for row in doctor_directory(
+        current_user.id, filters['q'], filters['specialization'], filters['state'], available_only=available_only
+    ).with_entities(Doctor.id, Doctor.updated_at).limit(per_page + 1).offset((filters['page'] - 1) * per_page)]
+
+def requests_version(*args, **kwargs):
+    return connections_version() + directory_page_version(True, DIRECTORY_PAGE_SIZE)
+
+def api_doctors_version(*args, **kwargs):
+    return connections_version() + directory_page_version(False, directory_per_page())
+
+def conversation_version(doctor_id, **kwargs):
+    row = db.session.execute(
+        select(func.count(Message.id), func.max(Message.id))
+        .where(archive.conversation(Message.__table__, current_user.id, doctor_id))
+    ).one()
+    return [current_user.id, *row]
 
 # Routes
 @app.route('/')
@@ -95,21 +621,20 @@ def index():
         return redirect(url_for('consultation'))
     return redirect(url_for('login'))
 
+def hashing_busy(template, message):
+    # The password pool is full: ask the client to come back rather than queue
+    flash(message, 'error')
+    return render_template(template), 503, {'Retry-After': str(PASSWORD_BUSY_RETRY_AFTER)}
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    print(f"Current user authenticated: {current_user.is_authenticated}")
-    
     if current_user.is_authenticated:
-        print("User already authenticated, redirecting to consultation")
         return redirect(url_for('consultation'))
     
     if request.method == 'POST':
         npi_id = request.form.get('npi_id')
         password = request.form.get('password')
         
-        print(f"Login attempt with NPI ID: {npi_id}")
-        print(f"Password provided: {bool(password)}")
-        
         if not npi_id or not password:
             flash('Please provide both NPI ID and password', 'error')
             return render_template('login.html')
@@ -117,22 +642,21 @@ def login():
         try:
             doctor = Doctor.query.filter_by(npi_id=npi_id).first()
             if doctor:
-                print(f"Found doctor: {doctor.full_name}")
-                print(f"Stored password hash: {doctor.password_hash}")
                 if doctor.check_password(password):
-                    print("Password check passed, logging in user")
+                    # Persist a rehash made by check_password, if any
+                    db.session.commit()
                     login_user(doctor, remember=True)
-                    print(f"User logged in, authenticated status: {current_user.is_authenticated}")
                     flash('Logged in successfully!', 'success')
                     return redirect(url_for('consultation'))
                 else:
-                    print("Password check failed")
+                    app.logger.info('Failed login for NPI ID %s', npi_id)
                     flash('Invalid password', 'error')
             else:
-                print("No doctor found with that NPI ID")
                 flash('No doctor found with that NPI ID', 'error')
-        except Exception as e:
-            print(f"Error during login: {str(e)}")
+        except PasswordHashingBusy:
+            return hashing_busy('login.html', 'Too many sign-ins at the moment. Please try again in a few seconds.')
+        except Exception:
+            app.logger.exception('Error during login')
             flash('An error occurred during login. Please try again.', 'error')
     
     return render_template('login.html')
@@ -169,7 +693,11 @@ def register():
             address=request.form.get('address'),
             avatar_path=None  # Set default avatar path to None
         )
-        doctor.set_password(request.form.get('password'))
+        try:
+            doctor.set_password(request.form.get('password'))
+        except PasswordHashingBusy:
+            return hashing_busy('register.html',
+                                'Too many registrations at the moment. Please try again in a few seconds.')
         
         db.session.add(doctor)
         db.session.commit()
@@ -188,34 +716,80 @@ def logout():
 @app.route('/profile')
 @login_required
 def profile():
+    counters = db.session.get(DoctorStats, current_user.id)
     stats = {
-        'total_consultations': 0,  # You can implement actual stats
-        'total_patients': 0,
-        'rating': 5.0
+        'total_consultations': counters.total_consultations if counters else 0,
+        'total_patients': counters.total_patients if counters else 0,
+        'rating': 5.0  # No ratings are collected yet
     }
     return render_template('profile.html', stats=stats)
 
 @app.route('/consultation')
 @login_required
+@conditional(appointments_version)
 def consultation():
-    incoming = Appointment.query.filter_by(receiver_id=current_user.id).all()
-    outgoing = Appointment.query.filter_by(sender_id=current_user.id).all()
-    return render_template('consultation.html', incoming=incoming, outgoing=outgoing)
+    filters = queue_args()
+    try:
+        cursors = {d: parse_queue_cursor(request.args.get(f'{d}_cursor')) for d in ('incoming', 'outgoing')}
+    except ValueError as e:
+        abort(400, str(e))
+    incoming, incoming_cursor = consultation_queue('incoming', current_user.id, cursor=cursors['incoming'], **filters)
+    outgoing, outgoing_cursor = consultation_queue('outgoing', current_user.id, cursor=cursors['outgoing'], **filters)
+    return render_template('consultation.html', incoming=incoming, outgoing=outgoing,
+                           incoming_cursor=incoming_cursor, outgoing_cursor=outgoing_cursor)
+
+@app.route('/api/consultations')
+@login_required
+@conditional(appointments_version, html=False)
+def api_consultations():
+    direction = request.args.get('direction', 'incoming')
+    if direction not in ('incoming', 'outgoing'):
+        return jsonify({'error': 'direction must be incoming or outgoing'}), 400
+    limit = max(1, min(request.args.get('limit', QUEUE_PAGE_SIZE, type=int), MAX_QUEUE_PAGE_SIZE))
+    try:
+        cursor = parse_queue_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    appointments, next_cursor = consultation_queue(
+        direction, current_user.id, cursor=cursor, limit=limit, **queue_args()
+    )
+    return jsonify({
+        'appointments': [{
+            'id': appointment.id,
+            'doctor_id': appointment.sender_id if direction == 'incoming' else appointment.receiver_id,
+            'doctor_name': (appointment.sender if direction == 'incoming' else appointment.receiver).full_name,
+            'date_time': appointment.date_time.strftime('%Y-%m-%dT%H:%M'),
+            'status': appointment.status,
+            'priority': appointment.priority
+        } for appointment in appointments],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/requests')
 @login_required
+@conditional(requests_version)
 def requests():
-    # Get all doctors except current user
-    doctors = Doctor.query.filter(Doctor.id != current_user.id).all()
+    # One page of doctors the user isn't connected to or waiting on
+    filters = directory_args()
+    rows, has_next = paginate_directory(
+        doctor_directory(current_user.id, filters['q'], filters['specialization'], filters['state'],
+                         available_only=True),
+        filters['page'], DIRECTORY_PAGE_SIZE
+    )
+    doctors = [doctor for doctor, _ in rows]
     
     # Get existing connections
-    connections = Connection.query.filter(
+    connections = Connection.query.options(
+        joinedload(Connection.doctor1), joinedload(Connection.doctor2)
+    ).filter(
         ((Connection.doctor1_id == current_user.id) | (Connection.doctor2_id == current_user.id)) &
         (Connection.status == 'accepted')
     ).all()
     
     # Get pending requests
-    pending_requests = Connection.query.filter(
+    pending_requests = Connection.query.options(
+        joinedload(Connection.doctor1), joinedload(Connection.doctor2)
+    ).filter(
         ((Connection.doctor1_id == current_user.id) | (Connection.doctor2_id == current_user.id)) &
         (Connection.status == 'pending')
     ).all()
@@ -223,24 +797,56 @@ def requests():
     return render_template('requests.html', 
                          doctors=doctors, 
                          connections=connections,
-                         pending_requests=pending_requests)
+                         pending_requests=pending_requests,
+                         filters=filters,
+                         has_next=has_next)
+
+@app.route('/api/doctors')
+@login_required
+@conditional(api_doctors_version, html=False)
+def api_doctors():
+    filters = directory_args()
+    per_page = directory_per_page()
+    rows, has_next = paginate_directory(
+        doctor_directory(current_user.id, filters['q'], filters['specialization'], filters['state']),
+        filters['page'], per_page
+    )
+    return jsonify({
+        'doctors': [{
+            'id': doctor.id,
+            'full_name': doctor.full_name,
+            'specialization': doctor.specialization,
+            'state': doctor.state,
+            'phone': doctor.phone,
+            'email': doctor.email,
+            'connection_status': connection_status(connection, current_user.id)
+        } for doctor, connection in rows],
+        'page': filters['page'],
+        'per_page': per_page,
+        'has_next': has_next
+    })
 
 @app.route('/send_request/<int:doctor_id>', methods=['POST'])
 @login_required
 def send_request(doctor_id):
-    # Check if request already exists
-    existing = Connection.query.filter(
-        ((Connection.doctor1_id == current_user.id) & (Connection.doctor2_id == doctor_id)) |
-        ((Connection.doctor1_id == doctor_id) & (Connection.doctor2_id == current_user.id))
-    ).first()
+    if doctor_id == current_user.id:
+        flash('You cannot connect with yourself')
+        return redirect(url_for('requests'))
     
-    if existing:
+    # Check if request already exists
+    if Connection.between(current_user.id, doctor_id):
         flash('Request already exists')
         return redirect(url_for('requests'))
     
     connection = Connection(doctor1_id=current_user.id, doctor2_id=doctor_id)
     db.session.add(connection)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent request for the same pair
+        db.session.rollback()
+        flash('Request already exists')
+        return redirect(url_for('requests'))
     
     flash('Connection request sent')
     return redirect(url_for('requests'))
@@ -260,6 +866,9 @@ def handle_request(request_id, action):
         connection.status = 'rejected'
     
     db.session.commit()
+    g.pop('connected_pairs', None)
+    for doctor_id in (connection.doctor1_id, connection.doctor2_id):
+        publish_event(doctor_id, 'connection', connection_id=connection.id, status=connection.status)
     flash(f'Request {action}ed')
     return redirect(url_for('requests'))
 
@@ -270,6 +879,8 @@ def book_appointment():
         doctor_id = request.form.get('doctor_id')
         date_time = datetime.strptime(request.form.get('appointment_datetime'), '%Y-%m-%dT%H:%M')
         priority = request.form.get('priority', 'normal')
+        if priority not in PRIORITY_ORDER:
+            priority = 'normal'
         
         if not doctor_id:
             flash('Please select a doctor', 'error')
@@ -281,6 +892,14 @@ def book_appointment():
             flash('Selected doctor not found', 'error')
             return redirect(url_for('book_appointment'))
         
+        # Reject overlapping bookings; the lock makes check-then-insert atomic
+        lock_schedule(doctor.id)
+        if scheduling.conflicts(booked_starts(doctor.id, date_time, date_time + APPOINTMENT_DURATION),
+                                date_time, APPOINTMENT_DURATION):
+            db.session.rollback()
+            flash(f'{doctor.full_name} already has an appointment at that time. Please pick another slot.', 'error')
+            return redirect(url_for('book_appointment'))
+        
         # Create the appointment
         appointment = Appointment(
             sender_id=current_user.id,
@@ -292,7 +911,12 @@ def book_appointment():
         
         db.session.add(appointment)
         try:
+            db.session.flush()
+            doctor_stats.apply_deltas(db.session.connection(), DoctorStats.__table__, doctor_stats.transition_deltas(
+                appointment.sender_id, appointment.receiver_id, None, appointment.status
+            ))
             db.session.commit()
+            publish_event(appointment.receiver_id, 'appointment', appointment_id=appointment.id, status=appointment.status)
             flash('Appointment booked successfully!', 'success')
             return redirect(url_for('consultation'))
         except Exception as e:
@@ -300,10 +924,36 @@ def book_appointment():
             flash('Error booking appointment. Please try again.', 'error')
             return redirect(url_for('book_appointment'))
     
-    # Get all doctors except current user
-    available_doctors = Doctor.query.filter(Doctor.id != current_user.id).all()
+    filters = directory_args()
+    rows, has_next = paginate_directory(
+        doctor_directory(current_user.id, filters['q'], filters['specialization'], filters['state']),
+        filters['page'], DIRECTORY_PAGE_SIZE
+    )
+    available_doctors = [doctor for doctor, _ in rows]
     
-    return render_template('book_appointment.html', doctors=available_doctors, now=datetime.now())
+    return render_template('book_appointment.html', doctors=available_doctors, now=datetime.now(),
+                           filters=filters, has_next=has_next)
+
+@app.route('/api/doctors/<int:doctor_id>/free_slots')
+@login_required
+def free_slots(doctor_id):
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d')
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'start and end are required as YYYY-MM-DD'}), 400
+    if end <= start or end - start > MAX_SLOT_RANGE:
+        return jsonify({'error': f'range must be between 1 and {MAX_SLOT_RANGE.days} days'}), 400
+    if not db.session.get(Doctor, doctor_id):
+        abort(404)
+
+    slots = scheduling.free_slots(booked_starts(doctor_id, start, end), start, end, APPOINTMENT_DURATION,
+                                  not_before=datetime.now())
+    return jsonify({
+        'doctor_id': doctor_id,
+        'duration_minutes': int(APPOINTMENT_DURATION.total_seconds() // 60),
+        'slots': [slot.strftime('%Y-%m-%dT%H:%M') for slot in slots]
+    })
 
 @app.route('/cancel_appointment/<int:appointment_id>', methods=['POST'])
 @login_required
@@ -314,8 +964,11 @@ def cancel_appointment(appointment_id):
         flash('Unauthorized')
         return redirect(url_for('consultation'))
     
-    appointment.status = 'cancelled'
+    if not change_appointment_status(appointment, 'cancelled'):
+        flash('This appointment was already updated', 'error')
+        return redirect(url_for('consultation'))
     db.session.commit()
+    publish_event(appointment.receiver_id, 'appointment', appointment_id=appointment.id, status=appointment.status)
     
     flash('Appointment cancelled')
     return redirect(url_for('consultation'))
@@ -323,61 +976,101 @@ def cancel_appointment(appointment_id):
 @app.route('/messages')
 @login_required
 def messages():
-    # Get connected doctors for the chat list
-    connections = Connection.query.filter(
-        ((Connection.doctor1_id == current_user.id) | (Connection.doctor2_id == current_user.id)) &
-        (Connection.status == 'accepted')
-    ).all()
-    
-    connected_doctors = []
-    for conn in connections:
-        if conn.doctor1_id == current_user.id:
-            doctor = Doctor.query.get(conn.doctor2_id)
-        else:
-            doctor = Doctor.query.get(conn.doctor1_id)
-        connected_doctors.append(doctor)
+    # Get connected doctors for the chat list in one query
+    partner_ids = db.session.query(Connection.doctor2_id).filter(
+        (Connection.doctor1_id == current_user.id) & (Connection.status == 'accepted')
+    ).union(db.session.query(Connection.doctor1_id).filter(
+        (Connection.doctor2_id == current_user.id) & (Connection.status == 'accepted')
+    ))
+    connected_doctors = Doctor.query.filter(Doctor.id.in_(partner_ids)).order_by(Doctor.full_name).all()
     
     return render_template('messages.html', doctors=connected_doctors)
 
 @app.route('/get_messages/<int:doctor_id>')
 @login_required
+@conditional(conversation_version, html=False)
 def get_messages(doctor_id):
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == doctor_id)) |
-        ((Message.sender_id == doctor_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.created_at).all()
-    
-    return jsonify([{
-        'id': msg.id,
-        'content': msg.content,
-        'file_path': msg.file_path,
-        'created_at': msg.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-        'is_sent': msg.sender_id == current_user.id
-    } for msg in messages])
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    limit = max(1, min(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), MAX_MESSAGE_PAGE_SIZE))
+
+    query = Message.query.filter(archive.conversation(Message.__table__, current_user.id, doctor_id))
+
+    if after_id is not None:
+        # Incremental sync: only messages newer than the client's cursor
+        messages = query.filter(Message.id > after_id).order_by(Message.id).limit(limit).all()
+    else:
+        # Initial load (the most recent page) or scroll-back (the page before
+        # before_id), returned oldest first. The hot table is read first and
+        # the archive fills the rest of the page once it runs out; archiving
+        # keeps only a conversation's latest message hot, so even the initial
+        # page may come mostly from the archive. An empty page means no more.
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        messages = query.order_by(Message.id.desc()).limit(limit).all()
+        messages.reverse()
+        if len(messages) < limit:
+            low_id, high_id = Connection.pair(current_user.id, doctor_id)
+            older = archive.archived_messages(
+                db.session.connection(), MessageArchiveSegment.__table__, low_id, high_id,
+                messages[0].id if messages else before_id, limit - len(messages)
+            )
+            messages = [Message(**record) for record in older] + messages
+
+    return jsonify([serialize_message(msg, current_user.id) for msg in messages])
+
+@app.route('/api/messages/search')
+@login_required
+def search_messages():
+    q = request.args.get('q', '').strip()
+    other_id = request.args.get('doctor_id', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = max(1, min(request.args.get('per_page', SEARCH_PAGE_SIZE, type=int), MAX_SEARCH_PAGE_SIZE))
+    if not q:
+        return jsonify({'error': 'q is required'}), 400
+
+    # One row past the page tells us whether there is a next one
+    results = search.search_messages(db.session.connection(), current_user.id, q,
+                                     per_page + 1, (page - 1) * per_page, other_id)
+    has_next = len(results) > per_page
+    results = results[:per_page]
+    for r in results:
+        r['doctor_id'] = r['receiver_id'] if r['sender_id'] == current_user.id else r['sender_id']
+    names = dict(db.session.query(Doctor.id, Doctor.full_name).filter(
+        Doctor.id.in_({r['doctor_id'] for r in results})
+    ).all()) if results else {}
+    return jsonify({
+        'results': [{
+            'id': r['id'],
+            'doctor_id': r['doctor_id'],
+            'doctor_name': names.get(r['doctor_id']),
+            'snippet': r['snippet'],
+            'filename': r['filename'],
+            'file_path': r['file_path'],
+            'created_at': r['created_at'].strftime('%Y-%m-%d %H:%M:%S'),
+            'is_sent': r['sender_id'] == current_user.id
+        } for r in results],
+        'page': page,
+        'per_page': per_page,
+        'has_next': has_next
+    })
 
 @app.route('/send_message', methods=['POST'])
 @login_required
 def send_message():
-    doctor_id = request.form.get('doctor_id')
+    doctor_id = request.form.get('doctor_id', type=int)
     content = request.form.get('content')
     file = request.files.get('file')
     
     # Check if doctors are connected
-    connection = Connection.query.filter(
-        ((Connection.doctor1_id == current_user.id) | (Connection.doctor2_id == current_user.id)) &
-        ((Connection.doctor1_id == doctor_id) | (Connection.doctor2_id == doctor_id)) &
-        (Connection.status == 'accepted')
-    ).first()
-    
-    if not connection:
+    if doctor_id is None or not current_user.is_connected_to(doctor_id):
         return jsonify({'error': 'Not connected with this doctor'}), 403
     
     file_path = None
     if file and file.filename:
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        file_path = url_for('static', filename=f'uploads/{filename}')
+        filename = secure_filename(file.filename) or 'attachment'
+        digest = attachments.save(file)
+        file_path = url_for('attachment', digest=digest, filename=filename)
     
     message = Message(
         sender_id=current_user.id,
@@ -387,14 +1080,68 @@ def send_message():
     )
     
     db.session.add(message)
-    db.session.commit()
-    
-    return jsonify({
+    db.session.flush()
+    # Indexed in the same transaction as the message itself
+    search.index_messages(db.session.connection(), [{
         'id': message.id,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'created_at': message.created_at,
         'content': message.content,
-        'file_path': message.file_path,
-        'created_at': message.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-        'is_sent': True
+        'file_path': message.file_path
+    }])
+    db.session.commit()
+    
+    publish_event(message.receiver_id, 'message', doctor_id=current_user.id,
+                  message=serialize_message(message, message.receiver_id))
+    publish_event(current_user.id, 'message', doctor_id=message.receiver_id,
+                  message=serialize_message(message, current_user.id))
+    
+    return jsonify(serialize_message(message, current_user.id))
+
+@app.route('/attachments/<digest>/<path:filename>')
+@login_required
+def attachment(digest, filename):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest) or not attachments.exists(digest):
+        abort(404)
+
+    # The content hash is a strong validator and the URL never changes content
+    response = send_file(
+        attachments.path(digest),
+        download_name=filename,
+        etag=digest,
+        conditional=True,
+        max_age=app.config['ATTACHMENT_MAX_AGE']
+    )
+    response.headers['Cache-Control'] = f"private, max-age={app.config['ATTACHMENT_MAX_AGE']}, immutable"
+    return response
+
+@app.route('/stream')
+@login_required
+def stream():
+    doctor_id = current_user.id
+    subscription = broker.subscribe(f'doctor:{doctor_id}')
+    keepalive = app.config['STREAM_KEEPALIVE_SECONDS']
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscription.get(timeout=keepalive)
+                if event is None:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                else:
+                    yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            subscription.close()
+
+    # The generator only reads the broker; give the session's pooled
+    # connection back now rather than holding it for the life of the stream
+    db.session.remove()
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
 @app.route('/upload_avatar', methods=['POST'])
@@ -408,25 +1155,80 @@ def upload_avatar():
         return jsonify({'success': False, 'error': 'No file selected'})
     
     if file and allowed_file(file.filename):
-        # Create a unique filename
-        filename = secure_filename(f"{current_user.id}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Delete old avatar if it exists
-        if current_user.avatar_path:
-            old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], current_user.avatar_path)
-            if os.path.exists(old_filepath):
-                os.remove(old_filepath)
-        
-        # Save new avatar
-        file.save(filepath)
-        current_user.avatar_path = filename
-        db.session.commit()
+        # Save the raw upload and resize it in the background
+        ext = file.filename.rsplit('.', 1)[1].lower()
+        raw_path = os.path.join(AVATAR_INBOX, f"{current_user.id}_{uuid.uuid4().hex}.{ext}")
+        file.save(raw_path)
+        image_pipeline.submit(process_avatar, current_user.id, raw_path)
         
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'processing': True})
     
     return jsonify({'success': False, 'error': 'Invalid file type'})
 
+def avatar_files(doctor):
+    files = set(filename for sizes in json.loads(doctor.avatar_variants or '{}').values() for filename in sizes.values())
+    if doctor.avatar_path:
+        files.add(doctor.avatar_path)
+    return files
+
+def process_avatar(doctor_id, raw_path):
+    # Runs on the image pipeline, outside any request
+    with app.app_context():
+        try:
+            variants = make_avatar_variants(raw_path, app.config['UPLOAD_FOLDER'])
+        except Exception as e:
+            app.logger.warning('Could not process avatar for doctor %s: %s', doctor_id, e)
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+            publish_event(doctor_id, 'avatar', success=False)
+            return
+
+        doctor = db.session.get(Doctor, doctor_id)
+        old_files = avatar_files(doctor)
+        largest = variants[max(variants, key=int)]
+        doctor.avatar_path = largest.get('jpeg') or largest.get('original')
+        doctor.avatar_variants = json.dumps(variants)
+        db.session.commit()
+
+        # Delete old avatar files that the new set doesn't reuse
+        for filename in old_files - avatar_files(doctor):
+            old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            if os.path.exists(old_filepath):
+                os.remove(old_filepath)
+        publish_event(doctor_id, 'avatar', success=True)
+
+@app.template_global()
+def avatar_srcset(doctor, fmt):
+    variants = json.loads(doctor.avatar_variants or '{}')
+    return ', '.join(
+        f"{url_for('static', filename='uploads/' + files[fmt])} {size}w"
+        for size, files in sorted(variants.items(), key=lambda item: int(item[0]))
+        if fmt in files
+    )
+
+@app.route('/badge_counts')
+@login_required
+def badge_counts():
+    counts = badge_cache.get(current_user.id)
+    if counts is None:
+        row = db.session.get(BadgeCounts, current_user.id)
+        counts = {counter: getattr(row, counter) if row else 0 for counter in badges.COUNTERS}
+        badge_cache.set(current_user.id, counts)
+    response = jsonify(counts)
+    response.add_etag()
+    response.headers['Cache-Control'] = f"private, max-age={app.config['BADGE_REFRESH_SECONDS'] // 2}"
+    return response.make_conditional(request)
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+    elif request.remote_addr not in LOCAL_ADDRESSES:
+        abort(403)
+    return Response(instrumentation.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/debug/users')
 def debug_users():
     doctors = Doctor.query.all()
@@ -446,14 +1248,15 @@ def handle_appointment(appointment_id, action):
         flash('Unauthorized', 'error')
         return redirect(url_for('consultation'))
     
+    new_status = 'accepted' if action == 'accept' else 'cancelled'
+    if action in ('accept', 'reject') and not change_appointment_status(appointment, new_status):
+        # Someone (e.g. the sender cancelling) changed it first
+        flash('This appointment was already updated', 'error')
+        return redirect(url_for('consultation'))
+
     if action == 'accept':
-        appointment.status = 'accepted'
-        
         # Check if a connection already exists between the doctors
-        existing_connection = Connection.query.filter(
-            ((Connection.doctor1_id == appointment.sender_id) & (Connection.doctor2_id == appointment.receiver_id)) |
-            ((Connection.doctor1_id == appointment.receiver_id) & (Connection.doctor2_id == appointment.sender_id))
-        ).first()
+        existing_connection = Connection.between(appointment.sender_id, appointment.receiver_id)
         
         # If no connection exists, create one
         if not existing_connection:
@@ -468,89 +1271,286 @@ def handle_appointment(appointment_id, action):
             flash('Appointment accepted', 'success')
             
     elif action == 'reject':
-        appointment.status = 'cancelled'
         flash('Appointment rejected', 'error')
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The pair got connected concurrently; keep the appointment change only
+        db.session.rollback()
+        change_appointment_status(appointment, new_status)
+        db.session.commit()
+    g.pop('connected_pairs', None)
+    for doctor_id in (appointment.sender_id, appointment.receiver_id):
+        publish_event(doctor_id, 'appointment', appointment_id=appointment.id, status=appointment.status)
     return redirect(url_for('consultation'))
 
-if __name__ == '__main__':
-    with app.app_context():
-        # Drop all tables and recreate them
-        db.drop_all()
-        db.create_all()
-        
-        # Create test doctors
-        test_doctors = [
-            {
-                'full_name': 'Dr. John Smith',
-                'email': 'john.smith@example.com',
-                'specialization': 'Cardiology',
-                'phone': '1234567890',
-                'npi_id': 'NPI001',
-                'state': 'CA',
-                'address': '123 Medical Center Dr',
-                'password': 'doctor123'
-            },
-            {
-                'full_name': 'Dr. Sarah Johnson',
-                'email': 'sarah.johnson@example.com',
-                'specialization': 'Neurology',
-                'phone': '2345678901',
-                'npi_id': 'NPI002',
-                'state': 'NY',
-                'address': '456 Hospital Ave',
-                'password': 'doctor123'
-            },
-            {
-                'full_name': 'Dr. Michael Chen',
-                'email': 'michael.chen@example.com',
-                'specialization': 'Pediatrics',
-                'phone': '3456789012',
-                'npi_id': 'NPI003',
-                'state': 'TX',
-                'address': '789 Children\'s Way',
-                'password': 'doctor123'
-            },
-            {
-                'full_name': 'Dr. Emily Brown',
-                'email': 'emily.brown@example.com',
-                'specialization': 'Dermatology',
-                'phone': '4567890123',
-                'npi_id': 'NPI004',
-                'state': 'FL',
-                'address': '321 Skin Care Blvd',
-                'password': 'doctor123'
-            }
-        ]
-        
-        print("\nCreating test doctors:")
+def import_doctors(stream, fmt):
+    records = bulk.read_records(stream, fmt)
+    pool = bulk.hash_pool(app.config['IMPORT_HASH_WORKERS'])
+    return bulk.import_doctors(
+        db.engine, Doctor.__table__, records,
+        lambda passwords: password_policy.hash_many(passwords, pool),
+        batch_size=app.config['IMPORT_BATCH_SIZE']
+    )
+
+def archived_export_rows(since=None, until=None):
+    # Archived messages for the audit export, as rows matching export_query('messages')
+    segments = MessageArchiveSegment.__table__
+    low, high = aliased(Doctor.__table__), aliased(Doctor.__table__)
+    query = (
+        select(segments.c.low_id, segments.c.high_id, segments.c.data,
+               low.c.npi_id.label('low_npi_id'), high.c.npi_id.label('high_npi_id'))
+        .join(low, low.c.id == segments.c.low_id)
+        .join(high, high.c.id == segments.c.high_id)
+        .order_by(segments.c.id)
+    )
+    if since:
+        query = query.where(segments.c.last_created_at >= since)
+    if until:
+        query = query.where(segments.c.first_created_at < until)
+    columns = [c.name for c in Message.__table__.c]
+
+    def rows(conn):
+        for segment in conn.execute(query):
+            npi_ids = {segment.low_id: segment.low_npi_id, segment.high_id: segment.high_npi_id}
+            for record in archive.decode_segment(segment.data):
+                if (since and record['created_at'] < since) or (until and record['created_at'] >= until):
+                    continue
+                yield [record[c] for c in columns] + [npi_ids[record['sender_id']], npi_ids[record['receiver_id']]]
+    return rows
+
+def export_query(kind, since=None, until=None):
+    # Rows in id order, with both doctors' NPI IDs joined in
+    table = {'appointments': Appointment, 'messages': Message}[kind].__table__
+    sender, receiver = aliased(Doctor.__table__), aliased(Doctor.__table__)
+    query = (
+        select(*table.c, sender.c.npi_id.label('sender_npi_id'), receiver.c.npi_id.label('receiver_npi_id'))
+        .join(sender, sender.c.id == table.c.sender_id)
+        .join(receiver, receiver.c.id == table.c.receiver_id)
+        .order_by(table.c.id)
+    )
+    if since:
+        query = query.where(table.c.created_at >= since)
+    if until:
+        query = query.where(table.c.created_at < until)
+    return query
+
+def require_admin_token():
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        abort(404)
+    if request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+
+@app.route('/api/admin/doctors/import', methods=['POST'])
+def api_import_doctors():
+    require_admin_token()
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'jsonl')
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(bulk.FORMATS)}"}), 400
+    # Read the body as it arrives instead of buffering it
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    report = import_doctors(stream, fmt)
+    return jsonify(report.to_dict())
+
+@app.route('/api/admin/export/<kind>')
+def api_export(kind):
+    require_admin_token()
+    if kind not in EXPORT_KINDS:
+        abort(404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(bulk.FORMATS)}"}), 400
+    since = request.args.get('since', type=datetime.fromisoformat)
+    until = request.args.get('until', type=datetime.fromisoformat)
+    if (since is None and 'since' in request.args) or (until is None and 'until' in request.args):
+        return jsonify({'error': 'since and until must be ISO dates'}), 400
+    chunks = bulk.export_rows(db.engine, export_query(kind, since, until), fmt,
+                              leading_rows=archived_export_rows(since, until) if kind == 'messages' else None)
+    return Response(chunks, mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson', headers={
+        'Content-Disposition': f'attachment; filename="{kind}.{fmt}"'
+    })
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Apply pending schema migrations."""
+    version = migrations.upgrade(db.engine, db.metadata)
+    print(f"Database schema is at version {version}")
+
+@app.cli.command('db-version')
+def db_version():
+    """Show the current and expected schema versions."""
+    print(f"current: {migrations.current_version(db.engine)}")
+    print(f"head:    {migrations.head_version()}")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Recompute every doctor's dashboard counters from the appointments."""
+    with db.engine.begin() as conn:
+        count = doctor_stats.rebuild(conn, Appointment.__table__, DoctorStats.__table__)
+    print(f"Rebuilt stats for {count} doctors")
+
+@app.cli.command('import-doctors')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), help='Defaults to the file extension.')
+def import_doctors_command(path, fmt):
+    """Register doctors in bulk from a CSV or JSONL file."""
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_doctors(f, fmt)
+    print(f"created {report.created}, duplicates {report.duplicates}, invalid {report.invalid}")
+    for error in report.errors:
+        print(f"  line {error['line']}: {error['error']}")
+
+@app.cli.command('export')
+@click.argument('kind', type=click.Choice(EXPORT_KINDS))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), default='csv')
+@click.option('--since', type=click.DateTime(), help='Only rows created at or after this time.')
+@click.option('--until', type=click.DateTime(), help='Only rows created before this time.')
+@click.option('--output', type=click.File('w'), default='-')
+def export_command(kind, fmt, since, until, output):
+    """Stream appointments or messages to CSV/JSONL for audits."""
+    leading_rows = archived_export_rows(since, until) if kind == 'messages' else None
+    for chunk in bulk.export_rows(db.engine, export_query(kind, since, until), fmt, leading_rows=leading_rows):
+        output.write(chunk)
+
+@app.cli.command('archive-messages')
+@click.option('--older-than', type=int, help='Age in days (default MESSAGE_ARCHIVE_AFTER_DAYS).')
+def archive_messages_command(older_than):
+    """Move old messages into compressed per-conversation archive segments."""
+    days = older_than if older_than is not None else app.config['MESSAGE_ARCHIVE_AFTER_DAYS']
+    count = archive.archive_messages(
+        db.engine, Message.__table__, MessageArchiveSegment.__table__,
+        datetime.utcnow() - timedelta(days=days), app.config['MESSAGE_ARCHIVE_SEGMENT_SIZE']
+    )
+    print(f"Archived {count} messages older than {days} days")
+
+@app.cli.command('run-worker')
+def run_worker():
+    """Run the background jobs in this process until interrupted."""
+    print(f"Running jobs: {', '.join(job.name for job in scheduler.jobs)}")
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+@app.cli.command('seed')
+def seed():
+    """Create the test doctors if they don't exist yet."""
+    test_doctors = [
+        {
+            'full_name': 'Dr. John Smith',
+            'email': 'john.smith@example.com',
+            'specialization': 'Cardiology',
+            'phone': '1234567890',
+            'npi_id': 'NPI001',
+            'state': 'CA',
+            'address': '123 Medical Center Dr',
+            'password': 'doctor123'
+        },
+        {
+            'full_name': 'Dr. Sarah Johnson',
+            'email': 'sarah.johnson@example.com',
+            'specialization': 'Neurology',
+            'phone': '2345678901',
+            'npi_id': 'NPI002',
+            'state': 'NY',
+            'address': '456 Hospital Ave',
+            'password': 'doctor123'
+        },
+        {
+            'full_name': 'Dr. Michael Chen',
+            'email': 'michael.chen@example.com',
+            'specialization': 'Pediatrics',
+            'phone': '3456789012',
+            'npi_id': 'NPI003',
+            'state': 'TX',
+            'address': '789 Children\'s Way',
+            'password': 'doctor123'
+        },
+        {
+            'full_name': 'Dr. Emily Brown',
+            'email': 'emily.brown@example.com',
+            'specialization': 'Dermatology',
+            'phone': '4567890123',
+            'npi_id': 'NPI004',
+            'state': 'FL',
+            'address': '321 Skin Care Blvd',
+            'password': 'doctor123'
+        }
+    ]
+    
+    print("\nCreating test doctors:")
+    print("----------------------")
+    existing = {npi_id for (npi_id,) in db.session.query(Doctor.npi_id).filter(
+        Doctor.npi_id.in_([d['npi_id'] for d in test_doctors])
+    )}
+    for doctor_data in test_doctors:
+        if doctor_data['npi_id'] in existing:
+            print(f"Skipping existing doctor: {doctor_data['full_name']}")
+            continue
+        doctor = Doctor(
+            full_name=doctor_data['full_name'],
+            email=doctor_data['email'],
+            specialization=doctor_data['specialization'],
+            phone=doctor_data['phone'],
+            npi_id=doctor_data['npi_id'],
+            state=doctor_data['state'],
+            address=doctor_data['address'],
+            avatar_path=None
+        )
+        doctor.set_password(doctor_data['password'])
+        db.session.add(doctor)
+        print(f"Created doctor: {doctor_data['full_name']}")
+        print(f"NPI ID: {doctor_data['npi_id']}")
+        print(f"Password: {doctor_data['password']}")
         print("----------------------")
-        for doctor_data in test_doctors:
-            doctor = Doctor(
-                full_name=doctor_data['full_name'],
-                email=doctor_data['email'],
-                specialization=doctor_data['specialization'],
-                phone=doctor_data['phone'],
-                npi_id=doctor_data['npi_id'],
-                state=doctor_data['state'],
-                address=doctor_data['address'],
-                avatar_path=None
-            )
-            doctor.set_password(doctor_data['password'])
-            db.session.add(doctor)
-            print(f"Created doctor: {doctor_data['full_name']}")
-            print(f"NPI ID: {doctor_data['npi_id']}")
-            print(f"Password: {doctor_data['password']}")
-            print("----------------------")
-        
-        try:
-            db.session.commit()
-            print("All test doctors created successfully!")
-        except Exception as e:
-            print(f"Error creating test doctors: {str(e)}")
-            db.session.rollback()
     
+    try:
+        db.session.commit()
+        print("All test doctors created successfully!")
+    except Exception as e:
+        print(f"Error creating test doctors: {str(e)}")
+        db.session.rollback()
+
+def verify_schema():
+    # Startup only checks the schema version; migrations run through `flask db-upgrade`
+    pending = migrations.pending_migrations(db.engine)
+    if pending:
+        raise SystemExit(
+            f"Database schema is at version {migrations.current_version(db.engine)}, "
+            f"expected {migrations.head_version()}. Run `flask --app app db-upgrade` first."
+        )
+
+# Migration commands have to run against a stale schema
+SCHEMA_CHECK_EXEMPT_COMMANDS = {'db-upgrade', 'db-version'}
+
+def check_schema_first(command):
+    callback = command.callback
+
+    @functools.wraps(callback)
+    def checked(*args, **kwargs):
+        with app.app_context():
+            verify_schema()
+        return callback(*args, **kwargs)
+
+    command.callback = checked
+
+# Checked on import so gunicorn workers refuse a stale schema too, as do
+# built-in commands like `flask run`. The flask group imports the app to look
+# up one of its own commands before running it, so those check when invoked.
+if app.config['SCHEMA_CHECK']:
+    cli_context = click.get_current_context(silent=True)
+    if cli_context is None or not isinstance(cli_context.command, click.Group):
+        with app.app_context():
+            verify_schema()
+    else:
+        for name, command in app.cli.commands.items():
+            if name not in SCHEMA_CHECK_EXEMPT_COMMANDS:
+                check_schema_first(command)
+
+if __name__ == '__main__':
     # Get port from environment variable for Render deployment
     port = int(os.environ.get('PORT', 5003))
     app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
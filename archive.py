@@ -0,0 +1,116 @@
+import gzip
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, case, func, or_, select
+
+# Message retention tiers. Recent messages live in the message table; older
+# ones are moved into message_archive_segment rows, each holding up to
+# `segment_size` consecutive messages of one conversation as gzipped JSONL.
+# A conversation's archive is always a prefix of its history by id, so
+# scrolling back reads the hot table first and only then the segments, newest
+# segment first, decompressing one at a time.
+
+
+def conversation(table, doctor_a_id, doctor_b_id):
+    return or_(
+        and_(table.c.sender_id == doctor_a_id, table.c.receiver_id == doctor_b_id),
+        and_(table.c.sender_id == doctor_b_id, table.c.receiver_id == doctor_a_id),
+    )
+
+
+def _row_to_record(row):
+    return {
+        'id': row.id,
+        'sender_id': row.sender_id,
+        'receiver_id': row.receiver_id,
+        'content': row.content,
+        'file_path': row.file_path,
+        'created_at': row.created_at.isoformat(),
+    }
+
+
+def encode_segment(rows):
+    return gzip.compress(''.join(json.dumps(_row_to_record(row)) + '\n' for row in rows).encode('utf-8'))
+
+
+def decode_segment(data):
+    records = []
+    for line in gzip.decompress(data).decode('utf-8').splitlines():
+        record = json.loads(line)
+        record['created_at'] = datetime.fromisoformat(record['created_at'])
+        records.append(record)
+    return records
+
+
+def archive_messages(engine, message_table, segment_table, cutoff, segment_size=500, log=None):
+    # Moves messages created before `cutoff` into archive segments. Each
+    # conversation keeps its latest message hot, which also keeps the
+    # table's highest id in place so SQLite never hands out an archived id
+    # again. Every segment is written and its messages deleted in one
+    # transaction. Returns the number of messages archived.
+    low = func.min(message_table.c.sender_id, message_table.c.receiver_id) \
+        if engine.dialect.name == 'sqlite' else func.least(message_table.c.sender_id, message_table.c.receiver_id)
+    high = func.max(message_table.c.sender_id, message_table.c.receiver_id) \
+        if engine.dialect.name == 'sqlite' else func.greatest(message_table.c.sender_id, message_table.c.receiver_id)
+    old = case((message_table.c.created_at < cutoff, message_table.c.id))
+
+    with engine.connect() as conn:
+        boundaries = conn.execute(
+            select(low.label('low_id'), high.label('high_id'),
+                   func.max(old).label('boundary'), func.max(message_table.c.id).label('latest'))
+            .group_by(low, high)
+            .having(func.max(old).isnot(None))
+        ).all()
+
+    archived = 0
+    for low_id, high_id, boundary, latest in boundaries:
+        if boundary == latest:
+            boundary -= 1
+        pair = conversation(message_table, low_id, high_id)
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(
+                    select(message_table).where(pair & (message_table.c.id <= boundary))
+                    .order_by(message_table.c.id).limit(segment_size)
+                ).all()
+                if not rows:
+                    break
+                conn.execute(segment_table.insert().values(
+                    low_id=low_id,
+                    high_id=high_id,
+                    first_message_id=rows[0].id,
+                    last_message_id=rows[-1].id,
+                    first_created_at=rows[0].created_at,
+                    last_created_at=rows[-1].created_at,
+                    message_count=len(rows),
+                    data=encode_segment(rows),
+                    created_at=datetime.utcnow(),
+                ))
+                conn.execute(message_table.delete().where(
+                    message_table.c.id.in_([row.id for row in rows])
+                ))
+            archived += len(rows)
+            if log:
+                log(f"Archived {len(rows)} messages between doctors {low_id} and {high_id}")
+    return archived
+
+
+def archived_messages(conn, segment_table, low_id, high_id, before_id, limit):
+    # Up to `limit` archived messages of a conversation with id < before_id
+    # (or the newest ones if before_id is None), returned oldest first
+    query = (
+        select(segment_table.c.data)
+        .where((segment_table.c.low_id == low_id) & (segment_table.c.high_id == high_id))
+        .order_by(segment_table.c.last_message_id.desc())
+    )
+    if before_id is not None:
+        query = query.where(segment_table.c.first_message_id < before_id)
+
+    records = []
+    for (data,) in conn.execute(query):
+        older = [r for r in decode_segment(data) if before_id is None or r['id'] < before_id]
+        records = older[-(limit - len(records)):] + records
+        if len(records) >= limit:
+            break
+    return records
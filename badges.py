@@ -0,0 +1,50 @@
+from sqlalchemy import case, func, literal, select, union_all
+
+# Navbar badge counts: pending connection requests and pending appointments
+# addressed to each doctor. Recomputed for everyone with one grouped query
+# on a schedule and stored in badge_counts, so /badge_counts is a primary
+# key lookup no matter how often the navbar asks. Pending appointments are
+# already counted per doctor in doctor_stats.pending_incoming (see stats.py),
+# so only connection requests are counted from their own table.
+COUNTERS = ('pending_requests', 'pending_appointments')
+
+
+def compute(conn, connection_table, stats_table):
+    # {doctor_id: {counter: n}} for every doctor with something pending
+    pending = union_all(
+        select(connection_table.c.doctor2_id.label('doctor_id'), literal('pending_requests').label('kind'),
+               literal(1).label('amount'))
+        .where(connection_table.c.status == 'pending'),
+        select(stats_table.c.doctor_id, literal('pending_appointments'), stats_table.c.pending_incoming)
+        .where(stats_table.c.pending_incoming > 0),
+    ).subquery()
+    rows = conn.execute(
+        select(pending.c.doctor_id,
+               *[func.sum(case((pending.c.kind == counter, pending.c.amount), else_=0)).label(counter)
+                 for counter in COUNTERS])
+        .group_by(pending.c.doctor_id)
+    ).mappings()
+    return {row['doctor_id']: {counter: row[counter] for counter in COUNTERS} for row in rows}
+
+
+def refresh(conn, connection_table, stats_table, badge_table, now):
+    # Writes only the rows that changed and returns {doctor_id: counts} for
+    # them (zeroed counts for doctors with nothing pending any more)
+    counts = compute(conn, connection_table, stats_table)
+    current = {row['doctor_id']: {counter: row[counter] for counter in COUNTERS}
+               for row in conn.execute(select(badge_table)).mappings()}
+
+    changed = {doctor_id: values for doctor_id, values in counts.items() if current.get(doctor_id) != values}
+    cleared = [doctor_id for doctor_id in current if doctor_id not in counts]
+
+    if cleared:
+        conn.execute(badge_table.delete().where(badge_table.c.doctor_id.in_(cleared)))
+    for doctor_id, values in changed.items():
+        if doctor_id in current:
+            conn.execute(badge_table.update().where(badge_table.c.doctor_id == doctor_id)
+                         .values(updated_at=now, **values))
+        else:
+            conn.execute(badge_table.insert().values(doctor_id=doctor_id, updated_at=now, **values))
+
+    changed.update({doctor_id: {counter: 0 for counter in COUNTERS} for doctor_id in cleared})
+    return changed
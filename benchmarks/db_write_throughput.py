@@ -0,0 +1,89 @@
+"""Concurrent SQLite write throughput, default settings vs. the tuned pragmas.
+
+Each worker process opens its own connection and inserts message rows, one
+commit per row like send_message does, for a fixed time. Run from the repo root:
+
+    python benchmarks/db_write_throughput.py --workers 8 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import configure_sqlite_connection  # noqa: E402
+
+SCHEMA = """
+CREATE TABLE message (
+    id INTEGER PRIMARY KEY,
+    sender_id INTEGER NOT NULL,
+    receiver_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL
+)
+"""
+
+
+def worker(path, tuned, seconds, worker_id, results):
+    conn = sqlite3.connect(path)
+    if tuned:
+        configure_sqlite_connection(conn)
+    writes = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            conn.execute(
+                "INSERT INTO message (sender_id, receiver_id, content, created_at) "
+                "VALUES (?, ?, ?, datetime('now'))",
+                (worker_id, worker_id + 1, 'benchmark message ' * 5)
+            )
+            conn.commit()
+            writes += 1
+        except sqlite3.OperationalError:
+            # "database is locked"
+            conn.rollback()
+            errors += 1
+    conn.close()
+    results.put((writes, errors))
+
+
+def run(tuned, workers, seconds):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        conn = sqlite3.connect(path)
+        conn.execute(SCHEMA)
+        conn.commit()
+        conn.close()
+
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=worker, args=(path, tuned, seconds, i, results))
+                 for i in range(workers)]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+
+    writes = sum(w for w, _ in totals)
+    errors = sum(e for _, e in totals)
+    return writes / seconds, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.workers} workers, {args.seconds}s each")
+    for label, tuned in (('default', False), ('tuned', True)):
+        rate, errors = run(tuned, args.workers, args.seconds)
+        print(f"{label:8} {rate:10.0f} writes/s  {errors:6d} lock errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Login throughput for each password hashing method.
+
+Measures password verifications per second on one thread (roughly logins
+per second per core) and on a PasswordPolicy pool sized to the CPU count.
+Run from the repo root:
+
+    python benchmarks/password_hashing.py --seconds 3
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordPolicy, argon2  # noqa: E402
+
+METHODS = ['pbkdf2:sha256:600000', 'pbkdf2:sha256:260000', 'scrypt:32768:8:1', 'scrypt:16384:8:1']
+if argon2 is not None:
+    METHODS.append('argon2')
+
+
+def verifications_per_second(policy, stored_hash, seconds, threads):
+    def loop():
+        count = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            policy.verify(stored_hash, 'doctor123')
+            count += 1
+        return count
+
+    with ThreadPoolExecutor(max_workers=threads) as callers:
+        total = sum(callers.map(lambda _: loop(), range(threads)))
+    return total / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+    cores = os.cpu_count() or 1
+
+    print(f"{cores} cores")
+    print(f"{'method':24} {'logins/s/core':>14} {'logins/s (pool of ' + str(cores) + ')':>22}")
+    for method in METHODS:
+        single = PasswordPolicy(method, max_workers=1)
+        pooled = PasswordPolicy(method, max_workers=cores)
+        stored_hash = single.hash('doctor123')
+        per_core = verifications_per_second(single, stored_hash, args.seconds, threads=1)
+        total = verifications_per_second(pooled, stored_hash, args.seconds, threads=cores * 2)
+        print(f"{method:24} {per_core:14.1f} {total:22.1f}")
+
+
+if __name__ == '__main__':
+    main()
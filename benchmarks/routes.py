@@ -0,0 +1,266 @@
+"""Route benchmark against a synthetic doctor network.
+
+Builds a throwaway SQLite database at the requested scale, then drives the
+real Flask routes through the test client and reports p50/p99 latency and
+throughput per scenario. Results can be saved as JSON and compared with a
+previous run to spot regressions between commits. Run from the repo root:
+
+    python benchmarks/routes.py --doctors 2000 --output baseline.json
+    python benchmarks/routes.py --doctors 2000 --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'doctor123'
+SPECIALIZATIONS = ['Cardiology', 'Neurology', 'Pediatrics', 'Dermatology', 'Oncology', 'Radiology']
+STATES = ['CA', 'NY', 'TX', 'FL', 'WA', 'IL', 'MA']
+FIRST_NAMES = ['John', 'Sarah', 'Michael', 'Emily', 'David', 'Priya', 'Wei', 'Fatima', 'Carlos', 'Anna']
+LAST_NAMES = ['Smith', 'Johnson', 'Chen', 'Brown', 'Garcia', 'Patel', 'Kim', 'Nguyen', 'Okafor', 'Rossi']
+
+
+def generate(app_module, doctors, connections_per_doctor, appointments, messages, seed):
+    # Bulk-load the synthetic network with Core inserts
+    db = app_module.db
+    rng = random.Random(seed)
+    password_hash = app_module.password_policy.hash(PASSWORD)
+
+    doctor_rows = [{
+        'id': i,
+        'full_name': f'Dr. {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+        'email': f'doctor{i}@example.com',
+        'specialization': rng.choice(SPECIALIZATIONS),
+        'phone': f'555{i:07d}',
+        'npi_id': f'NPI{i:07d}',
+        'state': rng.choice(STATES),
+        'address': f'{i} Synthetic Ave',
+        'password_hash': password_hash,
+    } for i in range(1, doctors + 1)]
+
+    pairs = {}
+    for doctor_id in range(1, doctors + 1):
+        for _ in range(connections_per_doctor):
+            other_id = rng.randint(1, doctors)
+            if other_id != doctor_id:
+                pair = (min(doctor_id, other_id), max(doctor_id, other_id))
+                pairs.setdefault(pair, (doctor_id, other_id, rng.choice(['accepted'] * 4 + ['pending'])))
+    connection_rows = [{
+        'doctor1_id': requester, 'doctor2_id': recipient, 'low_id': low, 'high_id': high, 'status': status,
+    } for (low, high), (requester, recipient, status) in pairs.items()]
+    accepted = [pair for pair, (_, _, status) in pairs.items() if status == 'accepted']
+
+    now = datetime.now()
+    appointment_rows = []
+    for _ in range(appointments):
+        sender_id, receiver_id = rng.sample(range(1, doctors + 1), 2)
+        appointment_rows.append({
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'date_time': now + timedelta(minutes=30 * rng.randint(-2000, 2000)),
+            'status': rng.choice(['pending', 'accepted', 'cancelled']),
+            'priority': rng.choice(['normal'] * 6 + ['urgent'] * 3 + ['emergency']),
+        })
+
+    message_rows = []
+    for _ in range(messages if accepted else 0):
+        a, b = rng.choice(accepted)
+        if rng.random() < 0.5:
+            a, b = b, a
+        message_rows.append({
+            'sender_id': a,
+            'receiver_id': b,
+            'content': 'Synthetic referral note ' * rng.randint(1, 4),
+            'created_at': now - timedelta(seconds=rng.randint(0, 90 * 24 * 3600)),
+        })
+
+    with db.engine.begin() as conn:
+        for table, rows in ((app_module.Doctor.__table__, doctor_rows),
+                            (app_module.Connection.__table__, connection_rows),
+                            (app_module.Appointment.__table__, appointment_rows),
+                            (app_module.Message.__table__, message_rows)):
+            for start in range(0, len(rows), 5000):
+                conn.execute(table.insert(), rows[start:start + 5000])
+        app_module.doctor_stats.rebuild(conn, app_module.Appointment.__table__, app_module.DoctorStats.__table__)
+        if conn.dialect.name == 'sqlite':
+            conn.exec_driver_sql('ANALYZE')
+    return accepted
+
+
+def login(client, doctor_id):
+    response = client.post('/login', data={'npi_id': f'NPI{doctor_id:07d}', 'password': PASSWORD})
+    assert response.status_code == 302, f'login failed for doctor {doctor_id}'
+
+
+def scenarios(accepted):
+    # Each scenario returns a callable(client, rng) -> response, for a client
+    # logged in as the first doctor of one of the accepted pairs
+    def pick(rng):
+        return rng.choice(accepted)
+
+    return {
+        'login': ('anonymous', lambda client, rng: client.post(
+            '/login', data={'npi_id': f'NPI{pick(rng)[0]:07d}', 'password': PASSWORD})),
+        'requests': ('session', lambda client, rng, me, other: client.get('/requests')),
+        'consultation': ('session', lambda client, rng, me, other: client.get('/consultation')),
+        'get_messages': ('session', lambda client, rng, me, other: client.get(f'/get_messages/{other}')),
+        'send_message': ('session', lambda client, rng, me, other: client.post(
+            '/send_message', data={'doctor_id': str(other), 'content': 'Benchmark message'})),
+    }
+
+
+def run_scenario(app, kind, action, accepted, requests, threads, seed):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(worker_id, count):
+        rng = random.Random(seed + worker_id)
+        client = app.test_client()
+        me, other = rng.choice(accepted)
+        if kind == 'session':
+            login(client, me)
+        for _ in range(count):
+            started = time.perf_counter()
+            if kind == 'session':
+                response = action(client, rng, me, other)
+            else:
+                response = action(app.test_client(), rng)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+    per_thread = [requests // threads + (1 if i < requests % threads else 0) for i in range(threads)]
+    pool = [threading.Thread(target=worker, args=(i, n)) for i, n in enumerate(per_thread)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'throughput_rps': round(len(latencies) / wall, 1),
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nChange vs {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_rps'):
+            if before[key]:
+                changes.append(f"{key} {100 * (result[key] - before[key]) / before[key]:+.1f}%")
+        print(f"  {name:14} " + '  '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doctors', type=int, default=1000)
+    parser.add_argument('--connections-per-doctor', type=int, default=10)
+    parser.add_argument('--appointments', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--login-requests', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--scenarios', default='login,requests,consultation,get_messages,send_message')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--compare', help='baseline JSON to diff against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='doclink-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['ATTACHMENT_FOLDER'] = os.path.join(workdir, 'attachments')
+    os.environ.setdefault('PUBSUB_BACKEND', 'local')
+    os.environ['SCHEMA_CHECK'] = 'off'
+
+    import app as app_module
+    import migrations
+
+    app = app_module.app
+    app.config['TESTING'] = True
+    with app.app_context():
+        migrations.upgrade(app_module.db.engine, app_module.db.metadata, log=lambda msg: None)
+        started = time.perf_counter()
+        accepted = generate(app_module, args.doctors, args.connections_per_doctor,
+                            args.appointments, args.messages, args.seed)
+        print(f"Generated {args.doctors} doctors, {args.appointments} appointments, {args.messages} messages "
+              f"in {time.perf_counter() - started:.1f}s")
+
+    results = {}
+    for name, (kind, action) in scenarios(accepted).items():
+        if name not in args.scenarios.split(','):
+            continue
+        count = args.login_requests if name == 'login' else args.requests
+        results[name] = run_scenario(app, kind, action, accepted, count, args.threads, args.seed)
+
+    print(f"\n{'scenario':14} {'requests':>8} {'errors':>6} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    for name, result in results.items():
+        print(f"{name:14} {result['requests']:8} {result['errors']:6} {result['p50_ms']:9.2f} "
+              f"{result['p99_ms']:9.2f} {result['throughput_rps']:8.1f}")
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'python': platform.python_version(),
+            'scale': {
+                'doctors': args.doctors,
+                'connections_per_doctor': args.connections_per_doctor,
+                'appointments': args.appointments,
+                'messages': args.messages,
+            },
+            'threads': args.threads,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
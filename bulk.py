@@ -0,0 +1,193 @@
+import atexit
+import csv
+import io
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+# Bulk onboarding and audit exports. Records are streamed in both
+# directions: imports read CSV/JSONL line by line and write in batches,
+# exports page through the table with a server-side cursor, so neither side
+# holds a whole file or table in memory.
+
+FORMATS = ('csv', 'jsonl')
+DOCTOR_FIELDS = ('full_name', 'email', 'specialization', 'phone', 'npi_id', 'state', 'address', 'password')
+MAX_REPORTED_ERRORS = 100
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+
+    def reject(self, line, reason, duplicate=False):
+        if duplicate:
+            self.duplicates += 1
+        else:
+            self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': reason})
+
+    def to_dict(self):
+        return {
+            'created': self.created,
+            'duplicates': self.duplicates,
+            'invalid': self.invalid,
+            'errors': self.errors,
+        }
+
+
+def hash_pool(max_workers=None):
+    # Process pool for import password hashing, shared by every import in
+    # this process. Started on first use, so web workers that never import
+    # don't carry idle hashing processes, and shut down at exit. Workers come
+    # from a fork server rather than forking the web process, whose other
+    # threads may hold locks at fork time that the child could never release.
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ProcessPoolExecutor(max_workers=max_workers,
+                                             mp_context=multiprocessing.get_context('forkserver'))
+            atexit.register(_hash_pool.shutdown)
+        return _hash_pool
+
+
+def read_records(stream, fmt):
+    # Yields (line_number, dict) from a text stream, one record at a time
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = e
+            yield line_number, record
+    else:
+        raise ValueError(f"Unsupported format {fmt!r}; expected one of {', '.join(FORMATS)}")
+
+
+def _clean_doctor(record, columns):
+    # Returns (row, error)
+    if isinstance(record, Exception):
+        return None, f'invalid JSON: {record}'
+    if not isinstance(record, dict):
+        return None, 'expected an object'
+    row = {}
+    for field in DOCTOR_FIELDS:
+        value = record.get(field)
+        value = str(value).strip() if value is not None else ''
+        if not value:
+            return None, f'missing {field}'
+        length = getattr(columns[field].type, 'length', None) if field in columns else None
+        if length and len(value) > length:
+            return None, f'{field} longer than {length} characters'
+        row[field] = value
+    row['email'] = row['email'].lower()
+    return row, None
+
+
+def import_doctors(engine, doctor_table, records, hash_passwords, batch_size=500):
+    # `records` are (line, dict) pairs from read_records(). NPI IDs and emails
+    # are checked against one prefetch of the existing values plus everything
+    # accepted earlier in the file; `hash_passwords` turns a list of passwords
+    # into a list of hashes for a whole batch at once.
+    report = ImportReport()
+    with engine.connect() as conn:
+        rows = conn.execute(select(doctor_table.c.npi_id, doctor_table.c.email)).all()
+    seen_npi_ids = {npi_id for npi_id, _ in rows}
+    seen_emails = {email.lower() for _, email in rows}
+    del rows
+
+    batch = []
+    for line, record in records:
+        row, error = _clean_doctor(record, doctor_table.c)
+        if error:
+            report.reject(line, error)
+            continue
+        if row['npi_id'] in seen_npi_ids:
+            report.reject(line, f"NPI ID {row['npi_id']} already registered", duplicate=True)
+            continue
+        if row['email'] in seen_emails:
+            report.reject(line, f"email {row['email']} already registered", duplicate=True)
+            continue
+        seen_npi_ids.add(row['npi_id'])
+        seen_emails.add(row['email'])
+        batch.append((line, row))
+        if len(batch) >= batch_size:
+            _insert_doctors(engine, doctor_table, batch, hash_passwords, report)
+            batch = []
+    if batch:
+        _insert_doctors(engine, doctor_table, batch, hash_passwords, report)
+    return report
+
+
+def _insert_doctors(engine, doctor_table, batch, hash_passwords, report):
+    hashes = hash_passwords([row.pop('password') for _, row in batch])
+    for (_, row), password_hash in zip(batch, hashes):
+        row['password_hash'] = password_hash
+    try:
+        with engine.begin() as conn:
+            conn.execute(doctor_table.insert(), [row for _, row in batch])
+        report.created += len(batch)
+    except IntegrityError:
+        # Someone registered one of these concurrently; retry row by row so
+        # only the clashing records are rejected
+        for line, row in batch:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(doctor_table.insert(), row)
+                report.created += 1
+            except IntegrityError:
+                report.reject(line, f"NPI ID {row['npi_id']} or email {row['email']} already registered",
+                              duplicate=True)
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def export_rows(engine, query, fmt, chunk_rows=1000, leading_rows=None):
+    # Yields the result of `query` as CSV or JSONL text chunks of `chunk_rows`
+    # rows, read from a streaming cursor. `leading_rows(conn)` may supply rows
+    # with the same columns to write before the query's own.
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    columns = list(query.selected_columns.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(columns)
+    with engine.connect() as conn:
+        def rows():
+            if leading_rows is not None:
+                yield from leading_rows(conn)
+            yield from conn.execution_options(stream_results=True, yield_per=chunk_rows).execute(query)
+
+        for count, row in enumerate(rows(), 1):
+            if fmt == 'csv':
+                writer.writerow(_json_value(value) for value in row)
+            else:
+                buffer.write(json.dumps({c: _json_value(v) for c, v in zip(columns, row)}) + '\n')
+            if count % chunk_rows == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,40 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # Small thread-safe LRU cache whose entries also expire after `ttl` seconds
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the
+# single writer, NORMAL sync is safe under WAL, and busy_timeout makes
+# writers wait for the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'foreign_keys': 'ON',
+    'temp_store': 'MEMORY',
+}
+
+
+def database_url():
+    url = os.environ.get('DATABASE_URL', 'sqlite:///doctor_referral.db')
+    # Render/Heroku still hand out the old scheme, which SQLAlchemy 2 rejects
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url):
+    if url.startswith('sqlite'):
+        # Pooling doesn't help SQLite; pragmas are set in the connect hook below
+        return {'connect_args': {'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000}}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+
+def configure_sqlite_connection(dbapi_connection, pragmas=SQLITE_PRAGMAS):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+@event.listens_for(Engine, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        configure_sqlite_connection(dbapi_connection)
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import json
+import os
+from functools import wraps
+
+from flask import Response, make_response, request, session
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; without it responses are gzipped only
+    brotli = None
+
+# HTTP-level caching for the app:
+# - conditional(): a view's ETag comes from a cheap version query run before
+#   the view, so an unchanged page is a 304 without rendering anything
+# - responses are compressed with brotli or gzip after the view runs
+# - url_for('static', ...) gets a content hash, and versioned static URLs are
+#   cached by browsers for a year
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'image/svg+xml')
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def init_app(app, min_size=512, gzip_level=6, brotli_quality=5):
+    app.config.setdefault('COMPRESS_MIN_SIZE', min_size)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', gzip_level)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', brotli_quality)
+    fingerprints = StaticFingerprints(app.static_folder)
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            digest = fingerprints.digest(values['filename'])
+            if digest:
+                values['v'] = digest
+
+    @app.after_request
+    def cache_and_compress(response):
+        if request.endpoint == 'static' and request.args.get('v'):
+            # The URL changes whenever the file does
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        return compress(response, app.config)
+
+
+def compress(response, config):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    data = response.get_data()
+    if encoding is None or len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    if encoding == 'br':
+        data = brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    else:
+        data = gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    # The encoded bytes differ from the identity ones, so a strong ETag must
+    # not be shared between them; the weak form still matches If-None-Match
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def conditional(version, html=True):
+    # Decorator for GET views. `version(*args, **kwargs)` returns a small,
+    # JSON-serializable value that changes whenever the view's output would
+    # (typically one aggregate query); it's combined with the URL into a weak
+    # ETag, and a matching If-None-Match gets a 304 without running the view.
+    # HTML views (html=True) render pending flashed messages, so they always
+    # run while there are some; JSON views never show them.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or (html and session.get('_flashes')):
+                return view(*args, **kwargs)
+            key = json.dumps([request.full_path, version(*args, **kwargs)], default=str)
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                # Same Vary as the 200 it stands for, which compress() negotiated
+                response.vary.add('Accept-Encoding')
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+class StaticFingerprints:
+    # Short content hashes of static files, recomputed when a file's mtime changes
+
+    def __init__(self, root):
+        self.root = root
+        self._digests = {}
+
+    def digest(self, filename):
+        path = os.path.join(self.root, filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._digests.get(filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()[:12]
+        self._digests[filename] = (mtime, digest)
+        return digest
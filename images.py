@@ -0,0 +1,62 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it avatars are stored as uploaded
+    Image = None
+
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True},
+}
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def make_avatar_variants(source_path, output_dir):
+    # Decode once, then write square WebP and JPEG crops at each size. Images
+    # are re-encoded from pixels only, so EXIF/GPS metadata is dropped.
+    # Returns {size: {format: filename}}; filenames carry the source hash, so
+    # they can be cached forever.
+    digest = file_digest(source_path)[:16]
+    os.makedirs(output_dir, exist_ok=True)
+
+    if Image is None:
+        ext = os.path.splitext(source_path)[1].lower() or '.img'
+        filename = f'avatar-{digest}{ext}'
+        os.replace(source_path, os.path.join(output_dir, filename))
+        return {str(max(AVATAR_SIZES)): {'original': filename}}
+
+    variants = {}
+    with Image.open(source_path) as image:
+        # Let the decoder downscale large JPEGs while decoding
+        image.draft('RGB', (max(AVATAR_SIZES) * 2, max(AVATAR_SIZES) * 2))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        for size in sorted(AVATAR_SIZES, reverse=True):
+            image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            variants[str(size)] = {}
+            for ext, options in AVATAR_FORMATS.items():
+                filename = f'avatar-{digest}-{size}.{ext}'
+                image.save(os.path.join(output_dir, filename), **options)
+                variants[str(size)][ext] = filename
+    os.remove(source_path)
+    return variants
+
+
+class ImagePipeline:
+    # Runs image jobs off the request thread on a small bounded pool
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='images')
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
@@ -0,0 +1,119 @@
+import cProfile
+import os
+import time
+from datetime import datetime
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Registry
+
+registry = Registry()
+
+request_latency = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint.', ('endpoint', 'method', 'status')
+)
+request_queries = registry.histogram(
+    'http_request_db_queries', 'SQL statements executed per request.', ('endpoint',),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+request_db_time = registry.histogram(
+    'http_request_db_seconds', 'Time spent in SQL per request.', ('endpoint',)
+)
+template_render_time = registry.histogram(
+    'template_render_seconds', 'Template render time.', ('template',)
+)
+upload_bytes = registry.counter(
+    'http_upload_bytes_total', 'Bytes received in multipart uploads.', ('endpoint',)
+)
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_start_template, app)
+    template_rendered.connect(_finish_template, app)
+
+    threshold_ms = app.config.get('PROFILE_SLOW_REQUESTS_MS')
+    if threshold_ms:
+        app.wsgi_app = SlowRequestProfiler(app.wsgi_app, threshold_ms / 1000, app.config['PROFILE_DIR'])
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+
+def _finish_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    endpoint = _endpoint()
+    request_latency.observe(time.perf_counter() - started,
+                            endpoint=endpoint, method=request.method, status=response.status_code)
+    request_queries.observe(g.db_queries, endpoint=endpoint)
+    request_db_time.observe(g.db_seconds, endpoint=endpoint)
+    if request.mimetype == 'multipart/form-data' and request.content_length:
+        upload_bytes.inc(request.content_length, endpoint=endpoint)
+    return response
+
+
+def _start_template(sender, template, context, **extra):
+    if has_request_context():
+        g.template_started = time.perf_counter()
+
+
+def _finish_template(sender, template, context, **extra):
+    if has_request_context() and 'template_started' in g:
+        template_render_time.observe(time.perf_counter() - g.pop('template_started'),
+                                     template=template.name or 'string')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if has_request_context() and started and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_seconds += time.perf_counter() - started.pop()
+
+
+class SlowRequestProfiler:
+    # WSGI middleware that runs each request under cProfile and keeps the
+    # stats of requests slower than `threshold` seconds in `profile_dir`.
+    # Only meant to be switched on while investigating latency.
+
+    def __init__(self, wsgi_app, threshold, profile_dir):
+        self.wsgi_app = wsgi_app
+        self.threshold = threshold
+        self.profile_dir = profile_dir
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active on this interpreter
+            return self.wsgi_app(environ, start_response)
+        started = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.threshold:
+                path = environ.get('PATH_INFO', '/').strip('/').replace('/', '_') or 'index'
+                filename = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{int(elapsed * 1000)}ms-{path[:60]}.prof"
+                profiler.dump_stats(os.path.join(self.profile_dir, filename))
@@ -0,0 +1,101 @@
+import bisect
+import threading
+
+# Minimal Prometheus-style metrics kept in process memory. Each worker
+# process exposes its own values; Prometheus sums them across scrape targets.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(series) for key, series in self._values.items()}
+        for key, series in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(self.labels, key, [("le", "+Inf")])} {series[-2]}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {series[-2]}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series[-1])}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
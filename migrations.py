@@ -0,0 +1,232 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, case, func, inspect, select
+
+import archive
+import badges
+import search
+import stats
+
+# Versioned schema migrations. Each migration is a function taking a
+# connection and the application's MetaData; it runs in its own transaction
+# and is recorded in schema_version. Keep them online-safe: only add tables,
+# nullable columns and indexes (built concurrently on Postgres), never
+# rewrite or drop data in place. The one exception is migration 11, which
+# deletes duplicate connection rows (keeping one per doctor pair) so that the
+# unique pair index of migration 12 can be built on legacy databases.
+
+MIGRATIONS = []
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, description, transactional=True):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, transactional, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def head_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(engine):
+    if not inspect(engine).has_table('schema_version'):
+        return 0
+    with engine.connect() as conn:
+        versions = conn.execute(select(schema_version.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+def pending_migrations(engine):
+    version = current_version(engine)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def upgrade(engine, metadata, log=print):
+    version_metadata.create_all(engine)
+    for version, description, transactional, fn in pending_migrations(engine):
+        log(f"Applying migration {version}: {description}")
+        if transactional:
+            with engine.begin() as conn:
+                fn(conn, metadata)
+                _record(conn, version, description)
+        else:
+            # e.g. CREATE INDEX CONCURRENTLY, which Postgres refuses inside a transaction
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                fn(conn, metadata)
+                _record(conn, version, description)
+    return current_version(engine)
+
+
+def _record(conn, version, description):
+    conn.execute(schema_version.insert().values(
+        version=version,
+        description=description,
+        applied_at=datetime.utcnow()
+    ))
+
+
+def create_tables(conn, metadata, *names):
+    metadata.create_all(conn, tables=[metadata.tables[name] for name in names], checkfirst=True)
+
+
+def add_column(conn, metadata, table_name, column_name):
+    # Adds a column declared on the model, if the table doesn't have it yet
+    if column_name in {c['name'] for c in inspect(conn).get_columns(table_name)}:
+        return
+    column = metadata.tables[table_name].c[column_name]
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}')
+
+
+def create_index(conn, metadata, table_name, index_name):
+    # Builds an index declared on the model; concurrently on Postgres, which
+    # needs the migration to be registered with transactional=False
+    table = metadata.tables[table_name]
+    index = next(i for i in table.indexes if i.name == index_name)
+    if conn.dialect.name == 'postgresql':
+        columns = ', '.join(c.name for c in index.columns)
+        unique = 'UNIQUE ' if index.unique else ''
+        where = index.dialect_options['postgresql']['where']
+        predicate = f' WHERE {where.text}' if where is not None else ''
+        conn.exec_driver_sql(
+            f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {table_name} ({columns}){predicate}'
+        )
+    else:
+        index.create(conn, checkfirst=True)
+
+
+@migration(1, 'initial schema')
+def initial_schema(conn, metadata):
+    create_tables(conn, metadata, 'doctor', 'connection', 'appointment', 'message')
+
+
+@migration(2, 'widen doctor.password_hash for scrypt/argon2 hashes')
+def widen_password_hash(conn, metadata):
+    # SQLite doesn't enforce VARCHAR lengths; on Postgres widening a varchar
+    # only touches the catalog, so this doesn't rewrite the table
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql('ALTER TABLE doctor ALTER COLUMN password_hash TYPE VARCHAR(256)')
+
+
+@migration(3, 'doctor_stats counters')
+def doctor_stats_table(conn, metadata):
+    create_tables(conn, metadata, 'doctor_stats')
+    stats.rebuild(conn, metadata.tables['appointment'], metadata.tables['doctor_stats'])
+
+
+@migration(4, 'consultation queue indexes', transactional=False)
+def consultation_queue_indexes(conn, metadata):
+    create_index(conn, metadata, 'appointment', 'ix_appointment_receiver_queue')
+    create_index(conn, metadata, 'appointment', 'ix_appointment_sender_queue')
+
+
+@migration(5, 'message archive segments')
+def message_archive_segments(conn, metadata):
+    create_tables(conn, metadata, 'message_archive_segment')
+
+
+@migration(6, 'message full-text search')
+def message_search_index(conn, metadata):
+    search.create_index(conn)
+    messages = metadata.tables['message']
+    for batch in conn.execute(select(messages).execution_options(yield_per=1000)).mappings().partitions():
+        search.index_messages(conn, batch)
+    segments = metadata.tables['message_archive_segment']
+    for (data,) in conn.execute(select(segments.c.data)):
+        search.index_messages(conn, archive.decode_segment(data))
+
+
+@migration(7, 'navbar badge counts')
+def badge_counts_table(conn, metadata):
+    create_tables(conn, metadata, 'badge_counts')
+    badges.refresh(conn, metadata.tables['connection'], metadata.tables['doctor_stats'],
+                   metadata.tables['badge_counts'], datetime.utcnow())
+
+
+@migration(8, 'partial indexes on pending requests and appointments', transactional=False)
+def pending_indexes(conn, metadata):
+    create_index(conn, metadata, 'connection', 'ix_connection_pending_doctor2')
+    create_index(conn, metadata, 'appointment', 'ix_appointment_pending_receiver')
+
+
+@migration(9, 'updated_at on doctors, connections and appointments')
+def updated_at_columns(conn, metadata):
+    for table_name in ('doctor', 'connection', 'appointment'):
+        add_column(conn, metadata, table_name, 'updated_at')
+
+
+@migration(10, 'doctor.updated_at index', transactional=False)
+def doctor_updated_at_index(conn, metadata):
+    create_index(conn, metadata, 'doctor', 'ix_doctor_updated_at')
+
+
+# Databases created by the original app (drop_all/create_all, no
+# schema_version) were stamped through migrations 1-10 without the columns
+# and indexes added to the models before migrations existed: the canonical
+# connection pair, avatar variants, the directory search index and the
+# directory/queue indexes. 11 and 12 bring them up to the models; on
+# databases created by migration 1 they do nothing beyond the FTS rebuild.
+
+CONNECTION_STATUS_RANK = {'accepted': 0, 'pending': 1}
+
+
+@migration(11, 'legacy baseline: missing columns, canonical connection pairs, directory search')
+def legacy_baseline(conn, metadata):
+    for table_name in ('doctor', 'connection', 'appointment', 'message'):
+        for column in metadata.tables[table_name].c:
+            add_column(conn, metadata, table_name, column.name)
+
+    connections = metadata.tables['connection']
+    doctor1_id, doctor2_id = connections.c.doctor1_id, connections.c.doctor2_id
+    conn.execute(connections.update().where(connections.c.low_id.is_(None)).values(
+        low_id=case((doctor1_id < doctor2_id, doctor1_id), else_=doctor2_id),
+        high_id=case((doctor1_id < doctor2_id, doctor2_id), else_=doctor1_id),
+    ))
+    # The old app could store both directions of a pair; keep one row per
+    # pair (accepted over pending over rejected, then the oldest) so the
+    # unique index in migration 12 can be built
+    pair = (connections.c.low_id, connections.c.high_id)
+    shared = select(*pair).group_by(*pair).having(func.count() > 1).subquery()
+    rows = conn.execute(
+        select(connections.c.id, connections.c.low_id, connections.c.high_id, connections.c.status)
+        .join(shared, (connections.c.low_id == shared.c.low_id) & (connections.c.high_id == shared.c.high_id))
+        .order_by(connections.c.id)
+    )
+    keep, duplicates = {}, []
+    for row in rows:
+        key = (row.low_id, row.high_id)
+        rank = CONNECTION_STATUS_RANK.get(row.status, len(CONNECTION_STATUS_RANK))
+        if key not in keep:
+            keep[key] = (rank, row.id)
+        elif rank < keep[key][0]:
+            duplicates.append(keep[key][1])
+            keep[key] = (rank, row.id)
+        else:
+            duplicates.append(row.id)
+    if duplicates:
+        conn.execute(connections.delete().where(connections.c.id.in_(duplicates)))
+
+    search.create_doctor_index(conn)
+
+
+@migration(12, 'legacy baseline: connection pair and model indexes', transactional=False)
+def legacy_baseline_indexes(conn, metadata):
+    inspector = inspect(conn)
+    existing = {i['name'] for i in inspector.get_indexes('connection')} | \
+        {c['name'] for c in inspector.get_unique_constraints('connection')}
+    if 'uq_connection_pair' not in existing:
+        concurrently = 'CONCURRENTLY ' if conn.dialect.name == 'postgresql' else ''
+        conn.exec_driver_sql(f'CREATE UNIQUE INDEX {concurrently}uq_connection_pair ON connection (low_id, high_id)')
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            create_index(conn, metadata, table.name, index.name)
@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+try:
+    import argon2
+except ImportError:  # argon2-cffi is optional; only needed for the 'argon2' method
+    argon2 = None
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
+
+def _hash_with(method, password):
+    # Module-level so it can be sent to a process pool
+    if method == 'argon2':
+        return argon2.PasswordHasher().hash(password)
+    return generate_password_hash(password, method=method)
+
+
+class PasswordPolicy:
+    # Hashes and verifies passwords with a configurable method:
+    #   'pbkdf2:sha256:600000', 'scrypt:32768:8:1' (werkzeug formats) or 'argon2'
+    # Work runs on a dedicated pool of `max_workers` threads (the hash
+    # functions release the GIL), so at most that many cores go to hashing no
+    # matter how many logins arrive at once. At most `max_workers * 4` calls
+    # are running or queued; callers beyond that wait up to `timeout`
+    # seconds (by default not at all) and then get PasswordHashingBusy, so a
+    # burst doesn't park request threads behind the queue.
+
+    def __init__(self, method='pbkdf2:sha256:600000', max_workers=2, timeout=0):
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='passwords')
+        self._slots = threading.BoundedSemaphore(max_workers * 4)
+        if method == 'argon2':
+            if argon2 is None:
+                raise RuntimeError("PASSWORD_HASH_METHOD=argon2 requires the argon2-cffi package")
+            self._argon2 = argon2.PasswordHasher()
+            self.method = method
+        else:
+            self._argon2 = None
+            # Let werkzeug fill in default parameters, e.g. 'scrypt' -> 'scrypt:32768:8:1'
+            self.method = generate_password_hash('', method=method).split('$', 1)[0]
+
+    def hash(self, password):
+        return self._run(self._hash, password)
+
+    def verify(self, stored_hash, password):
+        return self._run(self._verify, stored_hash, password)
+
+    def hash_many(self, passwords, executor):
+        # Bulk hashing for imports. Runs on the caller's (process) pool rather
+        # than the login pool, so a large import doesn't hold up sign-ins.
+        return list(executor.map(partial(_hash_with, self.method), passwords, chunksize=8))
+
+    def needs_rehash(self, stored_hash):
+        if stored_hash.startswith('$argon2'):
+            return self._argon2 is None or self._argon2.check_needs_rehash(stored_hash)
+        return self._argon2 is not None or stored_hash.split('$', 1)[0] != self.method
+
+    def _run(self, fn, *args):
+        if self.timeout:
+            acquired = self._slots.acquire(timeout=self.timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            raise PasswordHashingBusy()
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def _hash(self, password):
+        if self._argon2 is not None:
+            return self._argon2.hash(password)
+        return generate_password_hash(password, method=self.method)
+
+    def _verify(self, stored_hash, password):
+        if stored_hash.startswith('$argon2'):
+            if argon2 is None:
+                return False
+            try:
+                return argon2.PasswordHasher().verify(stored_hash, password)
+            except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+                return False
+        return check_password_hash(stored_hash, password)
@@ -0,0 +1,160 @@
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text, create_engine, func, select
+
+# Most skipped ids the database listener keeps looking for after one jump
+MAX_GAPS = 1000
+
+
+class Subscription:
+    def __init__(self, broker, channel, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Slow consumer: drop the event rather than block the publisher.
+            # Clients resync through /get_messages?after_id= anyway.
+            pass
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    # In-process fan-out. Only reaches subscribers in the same worker process.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def publish(self, channel, event):
+        self._deliver(channel, event)
+
+    def _deliver(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+class DatabaseBroker(LocalBroker):
+    # Cross-process fan-out through a shared events table. Publishers insert a
+    # row; one listener thread per worker process picks up new rows and hands
+    # them to its local subscribers, so the number of queries is per worker,
+    # not per open browser tab.
+
+    def __init__(self, url, poll_interval=0.25, retention=timedelta(minutes=5), settle_seconds=10):
+        super().__init__()
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.settle_seconds = settle_seconds
+        self.engine = create_engine(url, pool_pre_ping=True)
+        self.metadata = MetaData()
+        self.events = Table(
+            'pubsub_event', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('channel', String(100), nullable=False),
+            Column('payload', Text, nullable=False),
+            Column('created_at', DateTime, nullable=False, default=datetime.utcnow),
+        )
+        self.metadata.create_all(self.engine)
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def subscribe(self, channel):
+        self._ensure_listener()
+        return super().subscribe(channel)
+
+    def publish(self, channel, event):
+        with self.engine.begin() as conn:
+            conn.execute(self.events.insert().values(
+                channel=channel,
+                payload=json.dumps(event),
+                created_at=datetime.utcnow()
+            ))
+
+    def _ensure_listener(self):
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='pubsub-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        # Ids are handed out before commit (a Postgres sequence), so an insert
+        # that commits late can land below ids already delivered. Ids skipped
+        # over are kept as gaps and looked up again for `settle_seconds`,
+        # after which they're taken to be rolled back.
+        with self.engine.connect() as conn:
+            last_id = conn.execute(select(func.coalesce(func.max(self.events.c.id), 0))).scalar()
+        gaps = {}  # id -> monotonic time to stop looking for it
+
+        last_prune = time.monotonic()
+        while True:
+            try:
+                now = time.monotonic()
+                gaps = {event_id: until for event_id, until in gaps.items() if until > now}
+                new_rows = self.events.c.id > last_id
+                if gaps:
+                    new_rows = new_rows | self.events.c.id.in_(list(gaps))
+                with self.engine.connect() as conn:
+                    rows = conn.execute(
+                        select(self.events.c.id, self.events.c.channel, self.events.c.payload)
+                        .where(new_rows)
+                        .order_by(self.events.c.id)
+                    ).all()
+                for row in rows:
+                    if row.id > last_id:
+                        gaps.update((event_id, now + self.settle_seconds)
+                                    for event_id in range(last_id + 1, min(row.id, last_id + 1 + MAX_GAPS)))
+                        last_id = row.id
+                    else:
+                        gaps.pop(row.id, None)
+                    self._deliver(row.channel, json.loads(row.payload))
+
+                if time.monotonic() - last_prune > self.retention.total_seconds():
+                    with self.engine.begin() as conn:
+                        conn.execute(self.events.delete().where(
+                            self.events.c.created_at < datetime.utcnow() - self.retention
+                        ))
+                    last_prune = time.monotonic()
+            except Exception:
+                # Keep the listener alive through transient DB errors
+                time.sleep(1)
+            time.sleep(self.poll_interval)
+
+
+def create_broker(backend='local', url=None):
+    if backend == 'local':
+        return LocalBroker()
+    if backend == 'database':
+        return DatabaseBroker(url or 'sqlite:///pubsub.db')
+    raise ValueError(f"Unknown pub/sub backend: {backend}")
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+
+# Minimal periodic job runner. Web processes run it on a daemon thread
+# (start()); a dedicated worker process runs the same jobs in the foreground
+# (run_forever()) so the web processes can leave it switched off.
+
+
+class Job:
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.next_run = 0.0
+
+
+class Scheduler:
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name, interval, fn):
+        self.jobs.append(Job(name, interval, fn))
+
+    def start(self):
+        # Idempotent, so it can be called on every request
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run_forever, name='scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_pending(self):
+        now = time.monotonic()
+        for job in self.jobs:
+            if job.next_run <= now:
+                started = time.monotonic()
+                try:
+                    job.fn()
+                except Exception:
+                    self.logger.exception('Scheduled job %s failed', job.name)
+                else:
+                    self.logger.debug('Scheduled job %s took %.3fs', job.name, time.monotonic() - started)
+                job.next_run = now + job.interval
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            self.run_pending()
+            delay = min((job.next_run for job in self.jobs), default=60) - time.monotonic()
+            self._stop.wait(max(delay, 0.1))
@@ -0,0 +1,37 @@
+from bisect import bisect_left
+from datetime import datetime, time, timedelta
+
+# Appointments are stored as a start time only; every appointment occupies
+# a fixed-length interval starting there. All helpers work on a sorted list
+# of booked start times, so overlap checks are a binary search and listing
+# free slots is a single merge over the slots and the bookings.
+
+
+def conflicts(booked_starts, start, duration):
+    # True if [start, start + duration) overlaps any booked interval.
+    # Any booked start in (start - duration, start + duration) overlaps.
+    i = bisect_left(booked_starts, start - duration + timedelta(microseconds=1))
+    return i < len(booked_starts) and booked_starts[i] < start + duration
+
+
+def free_slots(booked_starts, range_start, range_end, duration, day_start=time(9), day_end=time(17),
+               weekdays=(0, 1, 2, 3, 4), not_before=None):
+    # Slot start times within working hours between range_start and
+    # range_end that don't overlap a booking
+    slots = []
+    i = 0
+    day = range_start.date()
+    while day <= range_end.date():
+        if day.weekday() in weekdays:
+            slot = datetime.combine(day, day_start)
+            closing = datetime.combine(day, day_end)
+            while slot + duration <= closing:
+                if range_start <= slot and slot + duration <= range_end and (not_before is None or slot >= not_before):
+                    # Skip bookings that end at or before this slot
+                    while i < len(booked_starts) and booked_starts[i] + duration <= slot:
+                        i += 1
+                    if i == len(booked_starts) or booked_starts[i] >= slot + duration:
+                        slots.append(slot)
+                slot += duration
+        day += timedelta(days=1)
+    return slots
@@ -0,0 +1,160 @@
+import posixpath
+import re
+from datetime import datetime
+
+from markupsafe import escape
+from sqlalchemy import text
+
+# Full-text search over message content and attachment filenames. SQLite
+# uses an FTS5 table, Postgres a tsvector column with a GIN index; either way
+# rows are keyed by message id and written when a message is sent. Index rows
+# are kept when messages are archived, so archived history stays searchable.
+#
+# Each row also indexes its two participants as tokens ("u12 u34"), so
+# scoping a search to the viewer's conversations is part of the index lookup
+# rather than a filter over every match.
+
+HIGHLIGHT_START, HIGHLIGHT_END = '\x01', '\x02'
+
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "content, filename, participants, sender_id UNINDEXED, receiver_id UNINDEXED, "
+    "created_at UNINDEXED, file_path UNINDEXED, tokenize='porter unicode61')",
+)
+POSTGRES_DDL = (
+    "CREATE TABLE IF NOT EXISTS message_search ("
+    "message_id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL, "
+    "created_at TIMESTAMP, content TEXT, file_path VARCHAR(200), document TSVECTOR NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_message_search_document ON message_search USING GIN (document)",
+)
+
+# Name/specialization search for the doctor directory: an external-content
+# FTS5 table over doctor kept in sync by triggers. SQLite only; other
+# backends use a LIKE match instead.
+DOCTOR_SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS doctor_fts USING fts5("
+    "full_name, specialization, content='doctor', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS doctor_fts_ai AFTER INSERT ON doctor BEGIN "
+    "INSERT INTO doctor_fts(rowid, full_name, specialization) VALUES (new.id, new.full_name, new.specialization); END",
+    "CREATE TRIGGER IF NOT EXISTS doctor_fts_ad AFTER DELETE ON doctor BEGIN "
+    "INSERT INTO doctor_fts(doctor_fts, rowid, full_name, specialization) "
+    "VALUES ('delete', old.id, old.full_name, old.specialization); END",
+    "CREATE TRIGGER IF NOT EXISTS doctor_fts_au AFTER UPDATE OF full_name, specialization ON doctor BEGIN "
+    "INSERT INTO doctor_fts(doctor_fts, rowid, full_name, specialization) "
+    "VALUES ('delete', old.id, old.full_name, old.specialization); "
+    "INSERT INTO doctor_fts(rowid, full_name, specialization) VALUES (new.id, new.full_name, new.specialization); END",
+)
+
+
+def supported(conn):
+    return conn.dialect.name in ('sqlite', 'postgresql')
+
+
+def create_index(conn):
+    for ddl in SQLITE_DDL if conn.dialect.name == 'sqlite' else POSTGRES_DDL if supported(conn) else ():
+        conn.exec_driver_sql(ddl)
+
+
+def create_doctor_index(conn):
+    # Creates the directory index if missing and rebuilds it from doctor
+    if conn.dialect.name != 'sqlite':
+        return
+    for ddl in DOCTOR_SQLITE_DDL:
+        conn.exec_driver_sql(ddl)
+    conn.exec_driver_sql("INSERT INTO doctor_fts(doctor_fts) VALUES ('rebuild')")
+
+
+def _participants(*doctor_ids):
+    return ' '.join(f'u{doctor_id}' for doctor_id in doctor_ids)
+
+
+def _filename_words(file_path):
+    # "/attachments/<digest>/echo_report_march.pdf" -> "echo report march pdf"
+    return re.sub(r'[\W_]+', ' ', posixpath.basename(file_path)).strip() if file_path else ''
+
+
+def index_messages(conn, messages):
+    # `messages` are rows or dicts with id, sender_id, receiver_id, created_at,
+    # content and file_path
+    rows = [{
+        'id': m['id'],
+        'sender_id': m['sender_id'],
+        'receiver_id': m['receiver_id'],
+        'created_at': m['created_at'],
+        'content': m['content'] or '',
+        'file_path': m['file_path'],
+        'filename': _filename_words(m['file_path']),
+        'participants': _participants(m['sender_id'], m['receiver_id']),
+    } for m in messages]
+    if not rows or not supported(conn):
+        return
+    if conn.dialect.name == 'sqlite':
+        for row in rows:
+            row['created_at'] = row['created_at'].isoformat(sep=' ')
+        conn.execute(text(
+            "INSERT INTO message_fts (rowid, content, filename, participants, sender_id, receiver_id, "
+            "created_at, file_path) VALUES (:id, :content, :filename, :participants, :sender_id, "
+            ":receiver_id, :created_at, :file_path)"
+        ), rows)
+    else:
+        conn.execute(text(
+            "INSERT INTO message_search (message_id, sender_id, receiver_id, created_at, content, file_path, "
+            "document) VALUES (:id, :sender_id, :receiver_id, :created_at, :content, :file_path, "
+            "to_tsvector('english', :content || ' ' || :filename) || to_tsvector('simple', :participants)) "
+            "ON CONFLICT (message_id) DO NOTHING"
+        ), rows)
+
+
+def search_messages(conn, viewer_id, q, limit, offset=0, other_id=None, window=1000):
+    # Ranked matches in the viewer's conversations (or only the one with
+    # other_id). Returns dicts with message fields, a relevance rank and an
+    # HTML snippet with the matched terms in <mark>. Only the newest `window`
+    # matches are ranked: walking matches in id order is cheap, scoring all
+    # of them is not, so a common term costs about as much as a rare one.
+    terms = re.findall(r'\w+', q)
+    if not terms or not supported(conn):
+        return []
+    scope = [viewer_id] + ([other_id] if other_id is not None else [])
+    params = {'limit': limit, 'offset': offset, 'window': window}
+
+    if conn.dialect.name == 'sqlite':
+        # Prefix match on every term within content or filename
+        params['match'] = ' AND '.join(
+            [f'participants:{token}' for token in _participants(*scope).split()] +
+            [f'{{content filename}}: "{term}"*' for term in terms]
+        )
+        params['oldest'] = conn.execute(text(
+            "SELECT rowid FROM message_fts WHERE message_fts MATCH :match "
+            "ORDER BY rowid DESC LIMIT 1 OFFSET :window - 1"
+        ), params).scalar() or 0
+        rows = conn.execute(text(
+            "SELECT rowid AS id, sender_id, receiver_id, created_at, file_path, bm25(message_fts) AS rank, "
+            f"snippet(message_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '...', 16) AS snippet "
+            "FROM message_fts WHERE message_fts MATCH :match AND rowid >= :oldest "
+            "ORDER BY rank LIMIT :limit OFFSET :offset"
+        ), params).mappings().all()
+    else:
+        params['scope'] = ' & '.join(_participants(*scope).split())
+        params['terms'] = ' & '.join(f'{term}:*' for term in terms)
+        rows = conn.execute(text(
+            "SELECT message_id AS id, sender_id, receiver_id, created_at, file_path, rank, "
+            f"ts_headline('english', content, query, 'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, "
+            "MaxFragments=1, MaxWords=16, MinWords=6') AS snippet "
+            "FROM (SELECT recent.*, -ts_rank(recent.document, recent.query) AS rank "
+            "      FROM (SELECT m.*, q AS query "
+            "            FROM message_search m, to_tsquery('english', :terms) AS q "
+            "            WHERE m.document @@ (q && to_tsquery('simple', :scope)) "
+            "            ORDER BY m.message_id DESC LIMIT :window) AS recent "
+            "      ORDER BY rank LIMIT :limit OFFSET :offset) AS page ORDER BY rank"
+        ), params).mappings().all()
+
+    results = []
+    for row in rows:
+        result = dict(row)
+        if isinstance(result['created_at'], str):
+            result['created_at'] = datetime.fromisoformat(result['created_at'])
+        result['snippet'] = str(escape(row['snippet'] or '')).replace(HIGHLIGHT_START, '<mark>') \
+            .replace(HIGHLIGHT_END, '</mark>')
+        result['filename'] = posixpath.basename(row['file_path']) if row['file_path'] else None
+        results.append(result)
+    return results
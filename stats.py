@@ -0,0 +1,76 @@
+from sqlalchemy import case, func, literal, select, union_all
+
+# Per-doctor dashboard counters, kept in the doctor_stats table and updated
+# incrementally whenever an appointment changes state. Each counter is the
+# number of appointments in a given status where the doctor plays a given role.
+COUNTERS = {
+    'total_consultations': (('sender', 'accepted'), ('receiver', 'accepted')),
+    'total_patients': (('receiver', 'accepted'),),
+    'pending_incoming': (('receiver', 'pending'),),
+}
+
+
+def contributions(sender_id, receiver_id, status):
+    # {doctor_id: {counter: amount}} for one appointment in the given status
+    result = {}
+    for counter, rules in COUNTERS.items():
+        for role, rule_status in rules:
+            if status == rule_status:
+                doctor_id = sender_id if role == 'sender' else receiver_id
+                counts = result.setdefault(doctor_id, {})
+                counts[counter] = counts.get(counter, 0) + 1
+    return result
+
+
+def transition_deltas(sender_id, receiver_id, old_status, new_status):
+    # Counter changes for an appointment moving from old_status to new_status
+    # (old_status is None for a new appointment)
+    deltas = contributions(sender_id, receiver_id, new_status)
+    if old_status is not None:
+        for doctor_id, counts in contributions(sender_id, receiver_id, old_status).items():
+            target = deltas.setdefault(doctor_id, {})
+            for counter, amount in counts.items():
+                target[counter] = target.get(counter, 0) - amount
+    return {doctor_id: {c: n for c, n in counts.items() if n}
+            for doctor_id, counts in deltas.items()
+            if any(counts.values())}
+
+
+def apply_deltas(conn, stats_table, deltas):
+    # Atomic "counter = counter + n" updates; creates missing rows
+    for doctor_id, counts in deltas.items():
+        result = conn.execute(
+            stats_table.update()
+            .where(stats_table.c.doctor_id == doctor_id)
+            .values({counter: stats_table.c[counter] + amount for counter, amount in counts.items()})
+        )
+        if result.rowcount == 0:
+            row = {counter: 0 for counter in COUNTERS}
+            row.update(counts)
+            conn.execute(stats_table.insert().values(doctor_id=doctor_id, **row))
+
+
+def rebuild(conn, appointment_table, stats_table):
+    # Recompute every doctor's counters from the appointment table with one
+    # grouped query, then replace the table contents
+    roles = union_all(
+        select(appointment_table.c.sender_id.label('doctor_id'), literal('sender').label('role'),
+               appointment_table.c.status),
+        select(appointment_table.c.receiver_id.label('doctor_id'), literal('receiver').label('role'),
+               appointment_table.c.status),
+    ).subquery()
+
+    columns = []
+    for counter, rules in COUNTERS.items():
+        matches = [(roles.c.role == role) & (roles.c.status == status) for role, status in rules]
+        condition = matches[0]
+        for match in matches[1:]:
+            condition = condition | match
+        columns.append(func.sum(case((condition, 1), else_=0)).label(counter))
+
+    rows = conn.execute(select(roles.c.doctor_id, *columns).group_by(roles.c.doctor_id)).mappings().all()
+
+    conn.execute(stats_table.delete())
+    if rows:
+        conn.execute(stats_table.insert(), [dict(row) for row in rows])
+    return len(rows)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingFile:
+    # Temporary file that hashes everything written to it. Used as the upload
+    # stream for multipart parsing so the body goes to disk in chunks and the
+    # digest is ready when parsing finishes.
+
+    def __init__(self, directory):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload-')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    @property
+    def digest(self):
+        return self.sha256.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put_file(self, key, source_path):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = f'{target}.{os.getpid()}.part'
+        try:
+            os.link(source_path, partial)
+        except OSError:
+            shutil.copyfile(source_path, partial)
+        # Atomic, so concurrent uploads of the same content never see a half-written file
+        os.replace(partial, target)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+
+class S3Storage:
+    # Works with any client exposing the boto3 S3 client methods used here
+    # (head_object, upload_file, get_object), e.g. boto3 against MinIO.
+    # Objects are immutable, so reads go through a local read-through cache.
+
+    def __init__(self, client, bucket, cache_dir, prefix='attachments/'):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache = LocalStorage(cache_dir)
+
+    def path(self, key):
+        if not self.cache.exists(key):
+            body = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body']
+            with tempfile.NamedTemporaryFile(dir=self.cache.root, prefix='download-') as download:
+                for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                    download.write(chunk)
+                download.flush()
+                self.cache.put_file(key, download.name)
+        return self.cache.path(key)
+
+    def exists(self, key):
+        if self.cache.exists(key):
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except Exception:
+            return False
+
+    def put_file(self, key, source_path):
+        self.client.upload_file(source_path, self.bucket, self.prefix + key)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+
+class AttachmentStore:
+    # Content-addressed store: files are keyed by their SHA-256, so identical
+    # uploads are kept once and names never collide.
+
+    def __init__(self, backend, tmp_dir):
+        self.backend = backend
+        self.tmp_dir = tmp_dir
+        os.makedirs(tmp_dir, exist_ok=True)
+
+    def spool_file(self):
+        return HashingFile(self.tmp_dir)
+
+    def save(self, file):
+        # Returns the content hash of a werkzeug FileStorage
+        stream = file.stream
+        if not isinstance(stream, HashingFile):
+            # Not parsed through the hashing request stream; copy it over in chunks
+            stream = self.spool_file()
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                stream.write(chunk)
+        stream.flush()
+
+        digest = stream.digest
+        if not self.backend.exists(digest):
+            self.backend.put_file(digest, stream.name)
+        return digest
+
+    def open(self, digest):
+        return self.backend.open(digest)
+
+    def path(self, digest):
+        return self.backend.path(digest)
+
+    def exists(self, digest):
+        return self.backend.exists(digest)
+
+
+def create_attachment_store(backend='local', root='attachments', bucket=None, endpoint_url=None):
+    if backend == 'local':
+        return AttachmentStore(LocalStorage(root), os.path.join(root, 'tmp'))
+    if backend == 's3':
+        import boto3
+        client = boto3.client('s3', endpoint_url=endpoint_url)
+        return AttachmentStore(S3Storage(client, bucket, os.path.join(root, 'cache')), os.path.join(root, 'tmp'))
+    raise ValueError(f"Unknown attachment backend: {backend}")
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time, so point it at a scratch
+# database before any test imports it
+WORKDIR = tempfile.mkdtemp(prefix='doclink-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'app.db')}"
+os.environ['ATTACHMENT_FOLDER'] = os.path.join(WORKDIR, 'attachments')
+os.environ['PUBSUB_BACKEND'] = 'local'
+os.environ['SCHEDULER'] = 'off'
+os.environ['SCHEMA_CHECK'] = 'off'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='module')
+def app_module():
+    # The app with an up-to-date, empty database; each test module seeds its own rows
+    import app
+    import migrations
+
+    app.app.config['TESTING'] = True
+    with app.app.app_context():
+        migrations.upgrade(app.db.engine, app.db.metadata, log=lambda msg: None)
+        with app.db.engine.begin() as conn:
+            for table in reversed(app.db.metadata.sorted_tables):
+                conn.execute(table.delete())
+    app.identity_cache.clear()
+    app.badge_cache.clear()
+    return app
+
+
+def login(client, doctor_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(doctor_id)
+        session['_fresh'] = True
@@ -0,0 +1,33 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import login
+
+
+@pytest.fixture(scope='module')
+def http(app_module):
+    with app_module.app.app_context(), app_module.db.engine.begin() as conn:
+        conn.execute(app_module.Doctor.__table__.insert().values(
+            id=1, full_name='Doctor 1', email='doctor1@example.com', specialization='Cardiology',
+            phone='555-0100', npi_id='NPI1', state='CA', address='1 Main St', password_hash='x',
+            updated_at=datetime.utcnow(),
+        ))
+    client = app_module.app.test_client()
+    login(client, 1)
+    return client
+
+
+@pytest.mark.parametrize('rank', ['-1', '3'])
+def test_cursor_rank_out_of_range_is_rejected(http, rank):
+    cursor = f'{rank}|2024-01-01T09:00:00|1'
+    response = http.get('/api/consultations', query_string={'cursor': cursor})
+    assert response.status_code == 400
+    assert 'rank' in response.get_json()['error']
+    assert http.get('/consultation', query_string={'incoming_cursor': cursor}).status_code == 400
+
+
+def test_cursor_in_range_is_accepted(http):
+    response = http.get('/api/consultations', query_string={'cursor': '2|2024-01-01T09:00:00|1'})
+    assert response.status_code == 200
+    assert response.get_json()['appointments'] == []
@@ -0,0 +1,30 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+
+def test_identity_evicted_only_after_commit(app_module):
+    db, Doctor = app_module.db, app_module.Doctor
+    with app_module.app.app_context():
+        db.session.execute(Doctor.__table__.insert().values(
+            id=1, full_name='Doctor 1', email='doctor1@example.com', specialization='Cardiology',
+            phone='555-0100', npi_id='NPI1', state='CA', address='1 Main St', password_hash='x',
+            updated_at=datetime.utcnow()
+        ))
+        db.session.commit()
+        assert app_module.load_user('1').phone == '555-0100'
+
+        doctor = db.session.get(Doctor, 1)
+        doctor.phone = '555-0199'
+        db.session.flush()
+        # Flushed but not committed: a request reading now still gets the old
+        # row, and the entry it caches must not survive the commit
+        stale = SimpleNamespace(**{c: getattr(doctor, c) for c in app_module.DoctorIdentity.COLUMNS})
+        stale.phone = '555-0100'
+        app_module.identity_cache.set(1, app_module.DoctorIdentity(stale))
+        db.session.commit()
+        assert app_module.load_user('1').phone == '555-0199'
+
+        doctor.phone = '555-0111'
+        db.session.flush()
+        db.session.rollback()
+        assert 'changed_doctors' not in db.session.info
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import archive
+from conftest import login
+
+
+def test_initial_load_and_scroll_back_reach_archived_history(app_module):
+    db = app_module.db
+    now = datetime.utcnow()
+    with app_module.app.app_context(), db.engine.begin() as conn:
+        conn.execute(app_module.Doctor.__table__.insert(), [{
+            'id': i, 'full_name': f'Doctor {i}', 'email': f'doctor{i}@example.com', 'specialization': 'Cardiology',
+            'phone': '555-0100', 'npi_id': f'NPI{i}', 'state': 'CA', 'address': f'{i} Main St',
+            'password_hash': 'x', 'updated_at': now,
+        } for i in (1, 2)])
+        conn.execute(app_module.Message.__table__.insert(), [{
+            'id': i, 'sender_id': 1 if i % 2 else 2, 'receiver_id': 2 if i % 2 else 1, 'content': f'message {i}',
+            'created_at': now - timedelta(days=365) + timedelta(minutes=i),
+        } for i in range(1, 31)])
+    with app_module.app.app_context():
+        archived = archive.archive_messages(db.engine, app_module.Message.__table__,
+                                            app_module.MessageArchiveSegment.__table__, now, segment_size=7)
+    # Only the latest message stays hot
+    assert archived == 29
+
+    client = app_module.app.test_client()
+    login(client, 1)
+    page = client.get('/get_messages/2?limit=8').get_json()
+    assert [m['id'] for m in page] == list(range(23, 31))
+    history = page
+    while page:
+        page = client.get(f"/get_messages/2?limit=8&before_id={history[0]['id']}").get_json()
+        history = page + history
+    assert [m['id'] for m in history] == list(range(1, 31))
+    assert history[0]['content'] == 'message 1' and history[0]['is_sent']
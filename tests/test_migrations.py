@@ -0,0 +1,88 @@
+import sqlite3
+
+from sqlalchemy import create_engine, inspect, text
+
+import app as app_module
+import migrations
+
+# Schema as created by the original app's db.create_all(), before versioned
+# migrations existed
+BASELINE_SCHEMA = """
+CREATE TABLE doctor (
+    id INTEGER NOT NULL, full_name VARCHAR(100) NOT NULL, email VARCHAR(120) NOT NULL,
+    specialization VARCHAR(100) NOT NULL, phone VARCHAR(20) NOT NULL, npi_id VARCHAR(50) NOT NULL,
+    state VARCHAR(50) NOT NULL, address VARCHAR(200) NOT NULL, password_hash VARCHAR(128) NOT NULL,
+    avatar_path VARCHAR(200),
+    PRIMARY KEY (id), UNIQUE (email), UNIQUE (npi_id)
+);
+CREATE TABLE connection (
+    id INTEGER NOT NULL, doctor1_id INTEGER NOT NULL, doctor2_id INTEGER NOT NULL,
+    status VARCHAR(20), created_at DATETIME,
+    PRIMARY KEY (id), FOREIGN KEY(doctor1_id) REFERENCES doctor (id), FOREIGN KEY(doctor2_id) REFERENCES doctor (id)
+);
+CREATE TABLE appointment (
+    id INTEGER NOT NULL, sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL, date_time DATETIME NOT NULL,
+    status VARCHAR(20), priority VARCHAR(20), created_at DATETIME,
+    PRIMARY KEY (id), FOREIGN KEY(sender_id) REFERENCES doctor (id), FOREIGN KEY(receiver_id) REFERENCES doctor (id)
+);
+CREATE TABLE message (
+    id INTEGER NOT NULL, sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL, content TEXT NOT NULL,
+    file_path VARCHAR(200), created_at DATETIME,
+    PRIMARY KEY (id), FOREIGN KEY(sender_id) REFERENCES doctor (id), FOREIGN KEY(receiver_id) REFERENCES doctor (id)
+);
+INSERT INTO doctor (id, full_name, email, specialization, phone, npi_id, state, address, password_hash)
+VALUES (1, 'Sarah Johnson', 'sarah@example.com', 'Cardiology', '555-0101', 'NPI1', 'CA', '1 Main St', 'x'),
+       (2, 'Michael Chen', 'michael@example.com', 'Neurology', '555-0102', 'NPI2', 'NY', '2 Main St', 'x'),
+       (3, 'Emily Davis', 'emily@example.com', 'Pediatrics', '555-0103', 'NPI3', 'TX', '3 Main St', 'x');
+INSERT INTO connection (id, doctor1_id, doctor2_id, status, created_at)
+VALUES (1, 2, 1, 'pending', '2024-01-01 09:00:00'),
+       (2, 1, 2, 'accepted', '2024-01-02 09:00:00'),
+       (3, 3, 1, 'rejected', '2024-01-03 09:00:00');
+INSERT INTO appointment (sender_id, receiver_id, date_time, status, priority, created_at)
+VALUES (2, 1, '2024-02-01 10:00:00', 'pending', 'urgent', '2024-01-05 09:00:00');
+INSERT INTO message (sender_id, receiver_id, content, created_at)
+VALUES (1, 2, 'Referral for the echocardiogram', '2024-01-06 09:00:00');
+"""
+
+
+def test_upgrade_baseline_database(tmp_path):
+    path = tmp_path / 'baseline.db'
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+    engine = create_engine(f'sqlite:///{path}')
+
+    version = migrations.upgrade(engine, app_module.db.metadata, log=lambda msg: None)
+
+    assert version == migrations.head_version()
+    assert not migrations.pending_migrations(engine)
+    inspector = inspect(engine)
+    for table in app_module.db.metadata.sorted_tables:
+        assert {c.name for c in table.c} <= {c['name'] for c in inspector.get_columns(table.name)}
+        assert {i.name for i in table.indexes} <= {i['name'] for i in inspector.get_indexes(table.name)}
+    assert any(i['name'] == 'uq_connection_pair' and i['unique'] for i in inspector.get_indexes('connection'))
+
+    with engine.begin() as conn:
+        # Duplicate directions of the 1-2 pair collapse into the accepted row
+        assert conn.execute(text(
+            'SELECT id, low_id, high_id, status FROM connection ORDER BY id'
+        )).all() == [(2, 1, 2, 'accepted'), (3, 1, 3, 'rejected')]
+        assert conn.execute(text(
+            "SELECT rowid FROM doctor_fts WHERE doctor_fts MATCH 'neuro*'"
+        )).scalars().all() == [2]
+        # The triggers keep the directory index in sync from here on
+        conn.execute(text("UPDATE doctor SET specialization = 'Cardiology' WHERE id = 3"))
+        assert conn.execute(text(
+            "SELECT rowid FROM doctor_fts WHERE doctor_fts MATCH 'cardio*' ORDER BY rowid"
+        )).scalars().all() == [1, 3]
+        assert conn.execute(text(
+            "SELECT rowid FROM message_fts WHERE message_fts MATCH 'echo*'"
+        )).scalars().all() == [1]
+
+
+def test_upgrade_new_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+    assert migrations.upgrade(engine, app_module.db.metadata, log=lambda msg: None) == migrations.head_version()
+    # The pair is already unique through the table's constraint; 12 adds no second index
+    inspector = inspect(engine)
+    assert [c['name'] for c in inspector.get_unique_constraints('connection')] == ['uq_connection_pair']
+    assert 'uq_connection_pair' not in {i['name'] for i in inspector.get_indexes('connection')}
@@ -0,0 +1,34 @@
+import time
+
+import pytest
+
+from passwords import PasswordHashingBusy, PasswordPolicy
+
+
+def test_full_pool_fails_fast():
+    policy = PasswordPolicy('pbkdf2:sha256:1000', max_workers=1)
+    # Every running/queued slot taken by other requests
+    for _ in range(4):
+        policy._slots.acquire()
+    started = time.monotonic()
+    with pytest.raises(PasswordHashingBusy):
+        policy.hash('pw')
+    assert time.monotonic() - started < 0.5
+    policy._slots.release()
+    assert policy.verify(policy.hash('pw'), 'pw')
+
+
+def test_busy_pool_returns_503(app_module, monkeypatch):
+    def busy(*args):
+        raise PasswordHashingBusy()
+
+    monkeypatch.setattr(app_module.password_policy, '_run', busy)
+    client = app_module.app.test_client()
+    response = client.post('/register', data={
+        'full_name': 'Dr Busy', 'email': 'busy@example.com', 'specialization': 'Cardiology', 'phone': '555',
+        'npi_id': 'BUSY1', 'state': 'CA', 'address': '1 Main St', 'password': 'pw', 'confirm_password': 'pw',
+    })
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app_module.PASSWORD_BUSY_RETRY_AFTER)
+    with app_module.app.app_context():
+        assert app_module.Doctor.query.filter_by(npi_id='BUSY1').first() is None
@@ -0,0 +1,33 @@
+import sqlite3
+import time
+
+from pubsub import DatabaseBroker
+
+
+def test_database_broker_delivers_late_committed_events(tmp_path):
+    path = tmp_path / 'pubsub.db'
+    broker = DatabaseBroker(f'sqlite:///{path}', poll_interval=0.01)
+    subscription = broker.subscribe('doctor:1')
+    time.sleep(0.1)
+
+    # Ids 1 and 3 commit; 2 was handed out first but commits afterwards
+    with sqlite3.connect(path) as conn:
+        for event_id in (1, 3):
+            conn.execute("INSERT INTO pubsub_event (id, channel, payload, created_at) "
+                         "VALUES (?, 'doctor:1', ?, datetime('now'))", (event_id, f'{{"n": {event_id}}}'))
+    assert [subscription.get(timeout=2), subscription.get(timeout=2)] == [{'n': 1}, {'n': 3}]
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO pubsub_event (id, channel, payload, created_at) "
+                     "VALUES (2, 'doctor:1', '{\"n\": 2}', datetime('now'))")
+    assert subscription.get(timeout=2) == {'n': 2}
+    assert subscription.get(timeout=0.2) is None
+
+
+def test_broker_failure_does_not_fail_the_request(app_module, monkeypatch, caplog):
+    def down(channel, event):
+        raise ConnectionError('broker down')
+
+    monkeypatch.setattr(app_module.broker, 'publish', down)
+    with app_module.app.app_context():
+        app_module.publish_event(1, 'message', doctor_id=2)
+    assert 'Could not publish message event to doctor 1' in caplog.text
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from conftest import login
+
+# Pages that render a list of related doctors must not issue a query per
+# row: the statement count for a page is the same with N rows as with 10N.
+
+N = 5
+ROUTES = ('/consultation', '/requests', '/messages')
+
+
+def seed(app_module, doctor_id, first_id, count):
+    # `count` more doctors; unless doctor_id is None, each is connected to
+    # doctor_id or has a pending request to them, and has an appointment in
+    # each direction with them
+    now = datetime(2030, 1, 1, 9, 0)
+    ids = range(first_id, first_id + count)
+    doctors = [{
+        'id': i, 'full_name': f'Doctor {i}', 'email': f'doctor{i}@example.com', 'specialization': 'Cardiology',
+        'phone': '555-0100', 'npi_id': f'NPI{i}', 'state': 'CA', 'address': f'{i} Main St',
+        'password_hash': 'x', 'updated_at': now,
+    } for i in ids]
+    connections = [{
+        'doctor1_id': i, 'doctor2_id': doctor_id, 'low_id': doctor_id, 'high_id': i,
+        'status': 'accepted' if i % 2 else 'pending', 'created_at': now, 'updated_at': now,
+    } for i in ids]
+    appointments = [{
+        'sender_id': sender_id, 'receiver_id': receiver_id, 'status': 'pending', 'priority': 'normal',
+        'date_time': now + timedelta(hours=i), 'created_at': now, 'updated_at': now,
+    } for i in ids for sender_id, receiver_id in ((i, doctor_id), (doctor_id, i))]
+    db = app_module.db
+    with app_module.app.app_context(), db.engine.begin() as conn:
+        conn.execute(app_module.Doctor.__table__.insert(), doctors)
+        if doctor_id is not None:
+            conn.execute(app_module.Connection.__table__.insert(), connections)
+            conn.execute(app_module.Appointment.__table__.insert(), appointments)
+
+
+def statement_count(app_module, client, path):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app_module.app.app_context():
+        engine = app_module.db.engine
+    client.get(path)  # warm the per-process caches (identity, badges)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = client.get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.fixture(scope='module')
+def counts(app_module):
+    seed(app_module, None, 1, 1)
+    client = app_module.app.test_client()
+    login(client, 1)
+    seed(app_module, 1, 2, N)
+    small = {path: statement_count(app_module, client, path) for path in ROUTES}
+    seed(app_module, 1, 2 + N, 9 * N)
+    large = {path: statement_count(app_module, client, path) for path in ROUTES}
+    return small, large
+
+
+@pytest.mark.parametrize('path', ROUTES)
+def test_statement_count_does_not_grow_with_rows(counts, path):
+    small, large = counts
+    assert large[path] == small[path]
+
@@ -0,0 +1,91 @@
+import io
+from datetime import datetime
+
+from werkzeug.datastructures import FileStorage
+
+from conftest import login
+from storage import AttachmentStore, S3Storage
+
+
+class FakeS3Client:
+    # In-memory stand-in for the boto3 S3 client calls S3Storage makes
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', Key))
+        if (Bucket, Key) not in self.objects:
+            raise KeyError(Key)  # boto3 raises botocore's ClientError (404)
+        return {'ContentLength': len(self.objects[Bucket, Key])}
+
+    def upload_file(self, Filename, Bucket, Key):
+        self.calls.append(('upload_file', Key))
+        with open(Filename, 'rb') as f:
+            self.objects[Bucket, Key] = f.read()
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(('get_object', Key))
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+    def count(self, method):
+        return sum(1 for name, _ in self.calls if name == method)
+
+
+DATA = bytes(range(256)) * 1000
+
+
+def s3_store(client, tmp_path, cache='cache'):
+    return AttachmentStore(S3Storage(client, 'attachments', str(tmp_path / cache)), str(tmp_path / 'tmp'))
+
+
+def test_s3_put_dedup_and_get(tmp_path):
+    client = FakeS3Client()
+    store = s3_store(client, tmp_path)
+    digest = store.save(FileStorage(io.BytesIO(DATA), filename='scan.bin'))
+    assert store.save(FileStorage(io.BytesIO(DATA), filename='copy.bin')) == digest
+    assert client.count('upload_file') == 1
+    assert list(client.objects) == [('attachments', f'attachments/{digest}')]
+
+    # Another worker, with a cold cache, downloads once and then reads locally
+    other = s3_store(client, tmp_path, cache='other-cache')
+    assert other.exists(digest) and not other.exists('0' * 64)
+    with other.open(digest) as f:
+        assert f.read() == DATA
+    with other.open(digest) as f:
+        assert f.read() == DATA
+    assert client.count('get_object') == 1
+
+
+def test_s3_attachment_range_reads(app_module, tmp_path, monkeypatch):
+    client = FakeS3Client()
+    monkeypatch.setattr(app_module, 'attachments', s3_store(client, tmp_path))
+    now = datetime.utcnow()
+    with app_module.app.app_context(), app_module.db.engine.begin() as conn:
+        conn.execute(app_module.Doctor.__table__.insert(), [{
+            'id': i, 'full_name': f'Doctor {i}', 'email': f'doctor{i}@example.com', 'specialization': 'Cardiology',
+            'phone': '555-0100', 'npi_id': f'NPI{i}', 'state': 'CA', 'address': f'{i} Main St',
+            'password_hash': 'x', 'updated_at': now,
+        } for i in (1, 2)])
+        conn.execute(app_module.Connection.__table__.insert().values(
+            doctor1_id=1, doctor2_id=2, low_id=1, high_id=2, status='accepted', created_at=now, updated_at=now
+        ))
+
+    http = app_module.app.test_client()
+    login(http, 1)
+    paths = [http.post('/send_message', data={
+        'doctor_id': '2', 'content': 'report', 'file': (io.BytesIO(DATA), 'report.bin'),
+    }, content_type='multipart/form-data').get_json()['file_path'] for _ in range(2)]
+    assert paths[0] == paths[1]
+    assert client.count('upload_file') == 1
+
+    # Served from a cold cache: one download, then byte ranges of the local copy
+    monkeypatch.setattr(app_module, 'attachments', s3_store(client, tmp_path, cache='cold-cache'))
+    response = http.get(paths[0], headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(DATA)}'
+    assert response.get_data() == DATA[1000:2000]
+    response = http.get(paths[0])
+    assert response.status_code == 200 and response.get_data() == DATA
+    assert client.count('get_object') == 1